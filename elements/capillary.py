@@ -11,6 +11,7 @@ import xrt.plotter as xrtp
 import xrt.backends.raycing.run as rr
 import xrt.backends.raycing.materials as rm
 import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
 
 from lenses import polycapillary as pl
 from utils import beam as ub
@@ -25,12 +26,16 @@ class StraightCapillaryTest(object):
         """ Tania przestrzen reklamowa """
         # This is neccessary
         self.beamLine = raycing.BeamLine()
-        self.beamTotal = None
+
+        # Photons of all runs (see utils.beam.BeamAccumulator)
+        self.beamTotal = ub.BeamAccumulator()
 
         # This is supposed to be an atomic iterator
         self.beam_iterator = itertools.count()
-        # Process that many photons in one raytraycing_run
-        self.beam_chunk_size = 1000
+        # Process that many photons in one raytraycing_run,
+        # None adjusts it to the cache size (see run_it)
+        self.beam_chunk_size = None
+        self.chunk_size = 1000
 
         # Default capillary position and radius
         # must be held by the test-object
@@ -56,6 +61,10 @@ class StraightCapillaryTest(object):
         self.source_beam = photons
         self.beam_iterator = itertools.count()
 
+    def set_beam_chunk_size(self, size):
+        """ Photons per run, None to fit the chunks in cache """
+        self.beam_chunk_size = size
+
     def set_far_screen_distance(self, dist):
         """ Away from outrance """
         self.far_screen_dist = self.y_outrance + dist
@@ -129,13 +138,13 @@ class StraightCapillaryTest(object):
 
             # This has to conserve the atomicity of the operation!
             local_it = self.beam_iterator.next()
-            rnga = local_it * self.beam_chunk_size
-            rngb = (local_it + 1) * self.beam_chunk_size
+            rnga = local_it * self.chunk_size
+            rngb = (local_it + 1) * self.chunk_size
 
             print 'Taking beam from', rnga, 'to', rngb
 
-            # This acts as xrt::shine()
-            beam = ub.copy_by_index(self.source_beam, range(rnga, rngb))
+            # This acts as xrt::shine(), without copying
+            beam = ub.slice_beam(self.source_beam, rnga, rngb)
 
             # Propagate photons through the capillary
             beamTotal, _ =\
@@ -143,10 +152,7 @@ class StraightCapillaryTest(object):
                                             maxReflections=50)
 
             # Hold photons for export
-            if self.beamTotal is None:
-                self.beamTotal = beamTotal
-            else:
-                self.beamTotal.concatenate(beamTotal)
+            self.beamTotal.append(beamTotal)
 
             # Use those screens for testing parameters
             exitScreen = beamLine.exitScreen.expose(beamTotal)
@@ -238,9 +244,18 @@ class StraightCapillaryTest(object):
 
         self.make_it()
 
+        # Chunk with tracing temporaries should stay in cache
+        if self.beam_chunk_size is None:
+            self.chunk_size = ub.cache_chunk_size(self.source_beam)
+        else:
+            self.chunk_size = self.beam_chunk_size
+
         # We want to go through the whole beam
         # Provide shorter beam if You fancy otherwise
-        _repeats = np.ceil(self.source_beam.x.size / self.beam_chunk_size)
+        _repeats = np.ceil(float(self.source_beam.x.size) / self.chunk_size)
+
+        # Every source photon ends up in the output beam
+        self.beamTotal.reserve(self.source_beam.x.size)
 
         xrtr.run_ray_tracing(self.plots,
                             repeats=_repeats,\
@@ -249,7 +264,7 @@ class StraightCapillaryTest(object):
 
     def get_beam(self):
         """ Get beamLine object holding all photon data """
-        return self.beamTotal
+        return self.beamTotal.finalize()
 
 def test_straight():
     """ Full test """
@@ -302,6 +317,43 @@ def create_straight_capillary(photons):
 
     return test.get_beam()
 
+def test_beam_chunks(nrays = 4000, chunk_size = 1000):
+    """ local_process traces views of the source beam
+    (see utils.beam.slice_beam): source photons are not
+    copied nor changed, and all of them end up in the output """
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(beamLine, 'source', (-1.0, 39, -1.0),
+                                nrays = nrays,
+                                distx = 'flat', dx = 0.5,
+                                distz = 'flat', dz = 0.5,
+                                distxprime = 'flat', dxprime = 0.005,
+                                distzprime = 'flat', dzprime = 0.005,
+                                distE = 'lines', energies = (9000,),
+                                polarization = None)
+    photons = source.shine()
+    x_before = photons.x.copy()
+
+    view = ub.slice_beam(photons, 0, chunk_size)
+    assert isinstance(view, rs.Beam)
+    assert np.may_share_memory(view.x, photons.x)
+    assert rs.Beam(copyFrom=view).state.size == chunk_size
+
+    test = StraightCapillaryTest()
+    test.set_beam(photons)
+    test.set_capillary_radius(1.0)
+    test.set_capillary_entrance(-1.0, -1.0)
+    test.set_material(mGlass)
+    test.set_visible(False)
+    test.make_it()
+    test.chunk_size = chunk_size
+
+    for it in range(nrays // chunk_size):
+        rr.run_process(test.beamLine)
+
+    beam = test.get_beam()
+    assert beam.state.size == nrays
+    assert np.array_equal(photons.x, x_before)
+
 class TaperedCapillaryTest(StraightCapillaryTest):
     """ This class is supposed to help with testing more complex
     capillary shapes: with straight axis and varying radius """
@@ -363,6 +415,70 @@ def test_tapered():
                             test.set_prefix(fix)
                             test.run_it()
 
+def compare_analytic_path(capillary, nrays = 10000, maxReflections = 50):
+    """ Traces the same beam through the closed-form and the generic
+    xrt path, returns max exit position difference and fraction
+    of rays with the same number of reflections """
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(beamLine, 'source',
+                                (capillary.entrance_x(),
+                                 capillary.entrance_y() - 1,
+                                 capillary.entrance_z()),
+                                nrays = nrays,
+                                distx = 'flat', dx = capillary.R_in/2.,
+                                distz = 'flat', dz = capillary.R_in/2.,
+                                distxprime = 'flat', dxprime = 0.005,
+                                distzprime = 'flat', dzprime = 0.005,
+                                distE = 'lines', energies = (9000,),
+                                polarization = None)
+    beam = source.shine()
+
+    capillary.analytic = True
+    fast, _ = capillary.multiple_reflect(beam, maxReflections=maxReflections)
+    capillary.analytic = False
+    compacted, capillary.compacted = capillary.compacted, False
+    slow, _ = capillary.multiple_reflect(beam, maxReflections=maxReflections)
+    capillary.compacted = compacted
+
+    # Compare on the exit plane, only rays good in both paths
+    good = (fast.state > 0) & (fast.state < 3) &\
+           (slow.state > 0) & (slow.state < 3)
+    ub.move_beam_to(fast, capillary.outrance_y())
+    ub.move_beam_to(slow, capillary.outrance_y())
+
+    dx = np.abs(fast.x[good] - slow.x[good]).max()
+    dz = np.abs(fast.z[good] - slow.z[good]).max()
+    same_refl = (fast.nRefl[good] == slow.nRefl[good]).mean()
+
+    return max(dx, dz), same_refl
+
+def test_analytic_path():
+    """ Regression of the closed-form cylinder/cone tracing
+    against the generic parametric-surface tracing """
+    beamLine = raycing.BeamLine()
+    straight = pl.StraightCapillary(beamLine, 'straightcap',
+                                    x_entrance = 0.3,
+                                    z_entrance = -0.2,
+                                    y_entrance = 40,
+                                    y_outrance = 140,
+                                    R_in = 0.5,
+                                    material = mGlass)
+    tapered = pl.LinearlyTapered(beamLine, 'taperedcap',
+                                 x_entrance = 0.3,
+                                 z_entrance = -0.2,
+                                 y_entrance = 40,
+                                 y_outrance = 120,
+                                 R_in = 0.5,
+                                 R_out = 0.1,
+                                 material = mGlass)
+
+    for capillary in [straight, tapered]:
+        assert capillary.is_analytic()
+        diff, same_refl = compare_analytic_path(capillary)
+        print capillary.name, 'max exit difference:', diff,\
+              'same reflections:', same_refl
+        assert diff < 1e-4
+        assert same_refl > 0.99
 
 if __name__ == '__main__':
     GlobalTotal = test_straight()
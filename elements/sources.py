@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.special import ndtri
 from utils import plotter as up
 
 import xrt.backends.raycing as raycing
@@ -11,66 +12,182 @@ class FitGeometricSource(rs.GeometricSource):
         """ Nothing different from the original constructor """
         rs.GeometricSource.__init__(self, *args, **kwargs)
 
+        # Photon positions and directions are drawn from here
+        # (see utils.streams), global numpy state by default
+        self.random_state = np.random
+
+        # Importance sampling of directions (see set_acceptance)
+        self.acceptance = None
+        self.acceptance_fraction = 0.9
+
+    def set_random_state(self, state):
+        """ np.random.RandomState used by shine and shine_many """
+        self.random_state = state
+
+    def set_acceptance(self, angle, fraction = 0.9):
+        """ Draw *fraction* of rays with directions within +-*angle*
+        of the entrance direction (rays the capillary can transmit),
+        None switches importance sampling off """
+        self.acceptance = angle
+        self.acceptance_fraction = fraction
+
+    # Uniform variates per ray used by draw_rays: position x and z,
+    # a choice and an offset for each direction and the energy
+    variates = 7
+
+    def direction_offsets(self, spread, choice, offset):
+        """ Direction offsets flat within +-*spread* and their
+        statistical weights, from uniform variates. With importance
+        sampling a part of rays comes from the acceptance window
+        only, weights are the flat density over the density
+        actually sampled """
+        offsets = 2 * offset - 1
+        window = self.acceptance
+        if window is None or window >= spread:
+            return spread * offsets, 1.
+
+        fraction = self.acceptance_fraction
+        offsets *= np.where(choice < fraction, window, spread)
+
+        inside = np.abs(offsets) <= window
+        density = (1 - fraction) + fraction * spread / window * inside
+        return offsets, 1. / density
+
+    def draw_energy(self, uniform):
+        """ Energies from uniform variates, same distributions
+        as xrt's make_energy. That one draws from the global
+        np.random and is still used for cases not handled here """
+        distE = None if self.filamentBeam else self.distE
+        energies = np.asarray(self.energies, dtype=float)
+        if distE == 'normal':
+            # Inverse cdf, variates are in [0, 1)
+            normal = ndtri(np.maximum(uniform, np.finfo(float).tiny))
+            return energies[0] + energies[1] * normal
+        if distE == 'flat':
+            return energies[0] + (energies[1] - energies[0]) * uniform
+        if distE in ('lines', 'line'):
+            ind = (uniform * energies.size).astype(int)
+            return energies[np.minimum(ind, energies.size - 1)]
+
+        # Filament beams have one energy for all rays
+        return rs.make_energy(self.distE, self.energies,\
+                              uniform.size, self.filamentBeam)
+
+    def draw_rays(self, uniform):
+        """ Random part of shine from an array of uniform variates
+        (see variates) with one column per ray, returns offsets of
+        positions and directions, weights and energies """
+        howmany = uniform.shape[1]
+
+        # TODO Add normal distribution!
+        dx = self.dx * (2 * uniform[0] - 1)
+        dz = self.dz * (2 * uniform[1] - 1)
+        da, weight_a = self.direction_offsets(self.dxprime,
+                                              uniform[2], uniform[3])
+        dc, weight_c = self.direction_offsets(self.dzprime,
+                                              uniform[4], uniform[5])
+        weight = weight_a * weight_c * np.ones(howmany)
+
+        # This assumes that distE is not None
+        E = self.draw_energy(uniform[6])
+
+        return dx, dz, da, dc, weight, E
+
     def shine(self, hitpoint = (0,10,0)):
         """ Source special logic, shine in direction defined by hitpoint"""
+        return self.shine_many([hitpoint], self.nrays)
+
+    def shine_many(self, hitpoints, nrays_per_hit = None, channels = None,
+                   streams = None):
+        """ Rays for many capillary entrances in one pass, each
+        *hitpoint* gets *nrays_per_hit* rays distributed as in shine.
+        Rays are tagged with the index of their hitpoint in beam.channel
+        (or with the matching entry of *channels*). All rays are drawn
+        at once from random_state, or with *streams* (see utils.streams)
+        rays of every hitpoint come from one draw of its own stream,
+        exactly as shine with the stream set as random_state """
         # Obsolete parameters used by the original shine() method
         toGlobal = True
         withAmplitudes = False
         accuBeam = None
 
+        hitpoints = np.asarray(hitpoints, dtype=float).reshape(-1, 3)
+        if nrays_per_hit is None:
+            nrays_per_hit = self.nrays
+        howmany = len(hitpoints) * nrays_per_hit
+
+        # Channel of every ray
+        if channels is None:
+            channels = np.arange(len(hitpoints))
+        channel = np.repeat(channels, nrays_per_hit)
+
         # Prepare beam to be returned
-        bo = rs.Beam(self.nrays,
+        bo = rs.Beam(howmany,
                      withAmplitudes=withAmplitudes)
         bo.state[:] = 1
+        bo.channel = channel
+
+        if streams is None:
+            uniform = self.random_state.random_sample((self.variates,
+                                                       howmany))
+        else:
+            shape = (self.variates, nrays_per_hit)
+            uniform = np.hstack([stream.random_sample(shape)
+                                 for stream in streams])
+        dx, dz, da, dc, weight, E = self.draw_rays(uniform)
 
+        # xrt distribution, from the global np.random
         self._apply_distribution(bo.y, self.disty, self.dy)
 
-        # TODO Add normal distribution!
         # We want to shine a flat distribution
-        # around the capillary entrance point
-        xMin, xMax = hitpoint[0] - self.dx, hitpoint[0] + self.dx
-        bo.x = np.random.uniform(xMin, xMax, self.nrays)
+        # around the capillary entrance points
+        x0 = np.repeat(hitpoints[:, 0], nrays_per_hit)
+        bo.x = x0 + dx
 
-        zMin, zMax = hitpoint[2] - self.dz, hitpoint[2] + self.dz
-        bo.z = np.random.uniform(zMin, zMax, self.nrays)
+        z0 = np.repeat(hitpoints[:, 2], nrays_per_hit)
+        bo.z = z0 + dz
 
         # Likewise we want the momentum to be distributed
         # around the direction of the capillary entrance
 
         # Only direction of momentum can be specified
         # so normalization is mandatory
-        normfactor = np.sqrt(sum([x**2 for x in hitpoint]))
+        normfactor = np.sqrt((hitpoints**2).sum(axis=1))
 
         # With momentum distribution in the x-direction ...
-        a0 = 1. * hitpoint[0] / normfactor
-        aMin, aMax = a0 - self.dxprime, a0 + self.dxprime
-        bo.a = np.random.uniform(aMin, aMax, self.nrays)
+        a0 = np.repeat(hitpoints[:, 0] / normfactor, nrays_per_hit)
+        bo.a = a0 + da
 
         #  ... and in the z-direction ...
-        c0 = 1. * hitpoint[2] / normfactor
-        cMin, cMax = c0 - self.dzprime, c0 + self.dzprime
-        bo.c = np.random.uniform(cMin, cMax, self.nrays)
+        c0 = np.repeat(hitpoints[:, 2] / normfactor, nrays_per_hit)
+        bo.c = c0 + dc
 
-        # ... we can find the momentum distribution in the y-direction
+        # ... we can find the momentum distribution in the y-direction,
+        # hitpoints with any ray too steep get all of their rays scaled
         ac = bo.a**2 + bo.c**2
-        if sum(ac > 1) > 0:
-            bo.b[:] = (ac + 1)**0.5
-            bo.a[:] /= bo.b
-            bo.c[:] /= bo.b
-            bo.b[:] = 1.0 / bo.b
-        else:
-            bo.b[:] = (1 - ac)**0.5
+        steep = (ac > 1).reshape(-1, nrays_per_hit).any(axis=1)
+        steep = np.repeat(steep, nrays_per_hit)
+        bo.b[:] = np.where(steep, (ac + 1)**0.5, np.abs(1 - ac)**0.5)
+        bo.a[steep] /= bo.b[steep]
+        bo.c[steep] /= bo.b[steep]
+        bo.b[steep] = 1.0 / bo.b[steep]
 
-        # This assumes that distE is not None
-        bo.E[:] = rs.make_energy(self.distE, self.energies,\
-                                 self.nrays, self.filamentBeam)
+        bo.E[:] = E
 
         # Add a container for number of reflections for each ray
         bo.nRefl = np.zeros_like(bo.state)
 
         # So far we neglect polarization, but it's needed
         # for xrt compatibility
-        rs.make_polarization(self.polarization, bo, self.nrays)
+        rs.make_polarization(self.polarization, bo, howmany)
+
+        # Importance sampled rays carry their weights in the
+        # intensities as well, so intensity results stay unbiased
+        if self.acceptance is not None:
+            bo.weight = weight
+            bo.Jss *= bo.weight
+            bo.Jpp *= bo.weight
+            bo.Jsp *= bo.weight
 
         # This assumes toGlobal is True
         raycing.virgin_local_to_global(self.bl, bo, self.center)
@@ -1,22 +1,58 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from random import random as rand
+from scipy.spatial import cKDTree
+from utils import streams as us
+
+def radius_shells(r, decimals = 9):
+    """ Indices of capillaries grouped by (rounded) distance *r*
+    from the lens axis, members of a shell differ only by rotation """
+    keys = np.round(np.asarray(r, dtype=float), decimals)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    # Stable sort keeps members in the structure order
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.cumsum(np.bincount(inverse))[:-1]
+    return np.split(order, bounds)
+
+class EntranceIndex(object):
+    """ KD-tree over capillary entrances, finds the channel
+    each ray enters in O(log N) """
+    def __init__(self, x, z, radius):
+        """ Entrance centers (x, z) and their common radius """
+        points = np.column_stack([np.ravel(x), np.ravel(z)])
+        self.tree = cKDTree(points)
+        self.radius = radius
+        self.size = points.shape[0]
+
+    def assign(self, x, z):
+        """ Index of the channel containing each (x, z) point,
+        -1 for points hitting the walls between channels """
+        points = np.column_stack([np.ravel(x), np.ravel(z)])
+        distance, channel = self.tree.query(points,
+                                            distance_upper_bound=self.radius)
+        # Misses are reported as infinite distance, index == size
+        channel[channel == self.size] = -1
+        return channel
+
+    @staticmethod
+    def groups(channel):
+        """ Pairs of (channel, indices of its rays), skipping misses """
+        order = np.argsort(channel, kind='mergesort')
+        ordered = channel[order]
+        starts = np.flatnonzero(np.diff(ordered)) + 1
+        for ids in np.split(order, starts):
+            if ids.size > 0 and channel[ids[0]] >= 0:
+                yield channel[ids[0]], ids
 
 class LensStructure(object):
     """ Generic class for capillary distributions at the lens entrance"""
     # FIXME radius should be a part of lens, not structure!
     def __init__(self, xci = 0, yci = 0, rIn = 0.05):
-        """ xci and zci can be lists """
+        """ xci and zci can be lists or arrays """
         self.rIn = rIn
 
-        # We need lists, but sometimes get points
-        if not isinstance(xci, list):
-            xci = [xci]
-        if not isinstance(yci, list):
-            yci = [yci]
-
-        self.xci = xci
-        self.yci = yci
+        # We need arrays, but sometimes get points
+        self.xci = np.atleast_1d(np.asarray(xci, dtype=float))
+        self.yci = np.atleast_1d(np.asarray(yci, dtype=float))
 
     def capillary_radius(self):
         """ Get it """
@@ -31,6 +67,21 @@ class LensStructure(object):
             phi = np.arctan2(y,x)
             yield r, phi
 
+    def entrance_index(self):
+        """ Spatial index of the channels in the structure plane """
+        return EntranceIndex(self.xci, self.yci, self.rIn)
+
+    def polar_arrays(self):
+        """ Same as polar_coordinates, but all at once """
+        r = np.hypot(self.xci, self.yci)
+        phi = np.arctan2(self.yci, self.xci)
+        return r, phi
+
+    def radius_shells(self, decimals = 9):
+        """ Capillary indices grouped by distance from the center """
+        r = np.hypot(self.xci, self.yci)
+        return radius_shells(r, decimals)
+
     def plot(self, savePath = None):
         """ Check the structure as separated from the capillaries """
         print 'Number of entrance channels:', len(self.xci)
@@ -49,8 +100,8 @@ class Singular(LensStructure):
 	# Init parent
 	LensStructure.__init__(self, rIn = rIn)
 
-	self.xci = [xin]
-	self.yci = [zin]
+	self.xci = np.array([xin], dtype=float)
+	self.yci = np.array([zin], dtype=float)
 
 class HexStructure(LensStructure):
     """ Most realistic pollycapilary structure """
@@ -58,10 +109,14 @@ class HexStructure(LensStructure):
                  rIn = 0.005,\
                  wall= 0.005,\
                  nx_capillary = 5,\
-                 ny_bundle = 3):
+                 ny_bundle = 3,\
+                 seed = None):
         """ Class encapsulating hexagonal structure of capillaries """
         # Init parent
         LensStructure.__init__(self, rIn = rIn)
+
+        # Position noise of the same seed gives the same lens
+        self.random_state = us.make_stream(seed, 'structure')
         # Outer diameter (touching)
         self.wall= wall
         self.capillary_diameter = 2*(self.rIn+self.wall)
@@ -92,92 +147,90 @@ class HexStructure(LensStructure):
         # Create the structure
         self.capillary_lens_xy()
 
-    def capillary_bundle_xy(self, xbundle, ybundle, sigma):
-        """ Generate budle of capillaries """
+    def grid(self, npol):
+        """ Hexagonal grid indices, ordered as in two nested loops:
+        for ix in range(-2*npol, 2*npol+1): for iy in (...) """
+        rng = np.arange(-2*npol, 2*npol + 1)
+        ix, iy = np.meshgrid(rng, rng, indexing='ij')
+        return ix.ravel(), iy.ravel()
+
+    def jitter(self, sigma, size):
+        """ Position noise, currently switched off (factor 0.) """
+        spread = sigma * (self.capillary_diameter - self.channel_diameter)
+        noise = self.random_state.random_sample(size) - 0.5
+        return 0. * spread * noise
+
+    def capillary_offsets(self, sigma, nbundles = 1):
+        """ Capillary positions relative to the bundle center,
+        rows of fresh noise for each of *nbundles* bundles
+        and the mask of capillaries kept in each bundle """
         nxpol_capillary = (self.nx_capillary - 1)/2
+        ix, iy = self.grid(nxpol_capillary)
+        shape = (nbundles, ix.size)
 
-        atemp = self.capillary_diameter * nxpol_capillary
-
-        # Prepare/Clear returned lists
-        xci = []
-        yci = []
-        for ix in range(-2*nxpol_capillary, 2*nxpol_capillary +1):
-            for iy in range(-2*nxpol_capillary, 2*nxpol_capillary +1):
+        x0 = self.capillary_diameter * ix +\
+            self.capillary_diameter/2. * iy +\
+            self.jitter(sigma, shape)
 
-                x0 = self.capillary_diameter * ix +\
-                    self.capillary_diameter/2.*iy + \
-                    0.* sigma * (rand() - 0.5) * \
-                    (self.capillary_diameter - self.channel_diameter)
+        y0 = np.sqrt(3)/2 * self.capillary_diameter * iy +\
+            self.jitter(sigma, shape)
 
-                y0 = np.sqrt(3)/2 * self.capillary_diameter * iy +\
-                    0.* sigma * (rand() - 0.5) * \
-                    (self.capillary_diameter - self.channel_diameter)
+        in_bundle = self.in_hexagon(x0, y0,\
+                    self.capillary_diameter * nxpol_capillary)
 
-                in_bundle = self.in_hexagon(x0, y0,\
-                            self.capillary_diameter * nxpol_capillary)
+        return x0, y0, in_bundle
 
-                if in_bundle:
-                    xci.append(xbundle + x0)
-                    yci.append(ybundle + y0)
-
-        return xci, yci
+    def capillary_bundle_xy(self, xbundle, ybundle, sigma):
+        """ Generate budle of capillaries """
+        x0, y0, in_bundle = self.capillary_offsets(sigma)
+        return xbundle + x0[in_bundle], ybundle + y0[in_bundle]
 
-    def capillary_lens_xy(self, sigma_position = 0.1):
-        """ Get coordinates of bundles within the lens """
+    def bundle_centers(self, sigma_position):
+        """ Centers of all bundles on the grid and
+        mask of those lying inside the lens """
         # This has to be an integer, do not add dots
         nypol_bundle = (self.ny_bundle - 1)/2
+        ix, iy = self.grid(nypol_bundle)
 
-        # Prepare return containers
-        xci = []
-        yci = []
-        xi = []
-        yi = []
-
-        # Add + 1 because range is 0 based...
-        for ix in range(-2*nypol_bundle, 2*nypol_bundle +1):
-            #print str(ix)
-            for iy in range(-2*nypol_bundle, 2*nypol_bundle +1):
-
-                x0 = np.sqrt(3)/2.0 * self.bundlespacing * iy +\
-                        0 * sigma_position * (rand()-0.5) *\
-                        (self.capillary_diameter - self.channel_diameter)
-
-                y0 = ix * self.bundlespacing + \
-                        iy * self.bundlespacing / 2.0 + \
-                        0 * sigma_position * (rand()-0.5) *\
-                        (self.capillary_diameter - self.channel_diameter)
-
-                # NOTE - look out for order of arguments (x and y)
-                in_lens = self.in_hexagon(y0, x0,\
-                          self.bundlespacing * nypol_bundle)
-
-                if in_lens:
-                    #print x0, y0
-                    xci0, yci0 = self.capillary_bundle_xy(x0, y0,\
-                                    sigma_position)
-                    # Appending single values simply extends the list
-                    xi.append(x0)
-                    yi.append(y0)
-                    # Appending lists creates a list of lists, we want
-                    # just a 1D vectors of capillaries' positions (?)
-                    # Joining lists is simply adding them
-                    xci = xci + xci0
-                    yci = yci + yci0
+        x0 = np.sqrt(3)/2.0 * self.bundlespacing * iy +\
+                self.jitter(sigma_position, iy.size)
+
+        y0 = ix * self.bundlespacing + \
+                iy * self.bundlespacing / 2.0 + \
+                self.jitter(sigma_position, ix.size)
+
+        # NOTE - look out for order of arguments (x and y)
+        in_lens = self.in_hexagon(y0, x0,\
+                  self.bundlespacing * nypol_bundle)
+
+        return x0, y0, in_lens
 
+    def set_bundles(self, xi, yi, sigma_position):
+        """ Fill the structure with bundles centered at (xi, yi) """
+        x0, y0, in_bundle = self.capillary_offsets(sigma_position, xi.size)
+
+        # Bundle after bundle (masking keeps the row order):
+        # same order as the old loop-and-append implementation
         self.xi = xi
         self.yi = yi
-        self.xci = xci
-        self.yci = yci
+        self.xci = (xi[:, np.newaxis] + x0)[in_bundle]
+        self.yci = (yi[:, np.newaxis] + y0)[in_bundle]
+
+    def capillary_lens_xy(self, sigma_position = 0.1):
+        """ Get coordinates of bundles within the lens """
+        x0, y0, in_lens = self.bundle_centers(sigma_position)
+        self.set_bundles(x0[in_lens], y0[in_lens], sigma_position)
 
     def in_hexagon(self, x, y, d):
-        """ Check if (x, y) is in a hexagon defined by *d* """
+        """ Check if (x, y) is in a hexagon defined by *d*,
+        works for arrays of points as well """
         tol = 1.001
 
-        war1 = abs(y) <= d * tol * np.sqrt(3)/2
-        war2 = abs(np.sqrt(3)/2* x + 1/2. * y) <= tol * d * np.sqrt(3)/2
-        war3 = abs(np.sqrt(3)/2* x - 1/2. * y) <= tol * d * np.sqrt(3)/2
+        war1 = np.abs(y) <= d * tol * np.sqrt(3)/2
+        war2 = np.abs(np.sqrt(3)/2* x + 1/2. * y) <= tol * d * np.sqrt(3)/2
+        war3 = np.abs(np.sqrt(3)/2* x - 1/2. * y) <= tol * d * np.sqrt(3)/2
 
-        return war1 and war2 and war3
+        return war1 & war2 & war3
 
 class PartialHexStructure(HexStructure):
     """ Create only some of the ny-bundles """
@@ -191,57 +244,15 @@ class PartialHexStructure(HexStructure):
 
     def capillary_lens_xy(self, sigma_position = 0.1):
         """ This creates only selected bundles """
-        # This has to be an integer, do not add dots
-        nypol_bundle = (self.ny_bundle - 1)/2
+        x0, y0, in_lens = self.bundle_centers(sigma_position)
 
-        # Prepare return containers
-        xci = []
-        yci = []
-        xi = []
-        yi = []
-
-        bundle_iterator = 0
-
-        # Add + 1 because range is 0 based...
-        for ix in range(-2*nypol_bundle, 2*nypol_bundle +1):
-            #print str(ix)
-            for iy in range(-2*nypol_bundle, 2*nypol_bundle +1):
-                # Skip unwanted bundles (0-based iterator)
-                bundle_iterator += 1
-                if bundle_iterator not in self.keep_us:
-                    continue
-
-                x0 = np.sqrt(3)/2.0 * self.bundlespacing * iy +\
-                        0 * sigma_position * (rand()-0.5) *\
-                        (self.capillary_diameter - self.channel_diameter)
-
-                y0 = ix * self.bundlespacing + \
-                        iy * self.bundlespacing / 2.0 + \
-                        0 * sigma_position * (rand()-0.5) *\
-                        (self.capillary_diameter - self.channel_diameter)
-
-                # NOTE - look out for order of arguments (x and y)
-                in_lens = self.in_hexagon(y0, x0,\
-                          self.bundlespacing * nypol_bundle)
-
-                if in_lens:
-                    print bundle_iterator
-                    #print x0, y0
-                    xci0, yci0 = self.capillary_bundle_xy(x0, y0,\
-                                    sigma_position)
-                    # Appending single values simply extends the list
-                    xi.append(x0)
-                    yi.append(y0)
-                    # Appending lists creates a list of lists, we want
-                    # just a 1D vectors of capillaries' positions (?)
-                    # Joining lists is simply adding them
-                    xci = xci + xci0
-                    yci = yci + yci0
+        # Skip unwanted bundles (1-based grid position)
+        bundle_iterator = np.arange(1, x0.size + 1)
+        keep = in_lens & np.in1d(bundle_iterator, self.keep_us)
+        for it in bundle_iterator[keep]:
+            print it
 
-        self.xi = xi
-        self.yi = yi
-        self.xci = xci
-        self.yci = yci
+        self.set_bundles(x0[keep], y0[keep], sigma_position)
 
 class BunchOfBundles(LensStructure):
     """ Set of capillary hexagons with arbitrary positions """
@@ -256,39 +267,27 @@ class BunchOfBundles(LensStructure):
                           ny_bundle = 1);
 
         # .. and use it to create bundles centered at wherever
-        xbundles = [0.4, -0.2, 0.0]
-        ybundles = [-0.1, 0.4, 0.3]
-
-        # Structure containers
-        xci = yci = []
-
-        for x, y in zip(xbundles, ybundles):
-            new_x, new_y = hx.capillary_bundle_xy(x, y, 0)
-            xci = xci + new_x
-            yci = yci + new_y
+        xbundles = np.array([0.4, -0.2, 0.0])
+        ybundles = np.array([-0.1, 0.4, 0.3])
 
         # This might become: self.set_structure(xci, yci)
-        self.xci = xci
-        self.yci = yci
+        hx.set_bundles(xbundles, ybundles, 0)
+        self.xci = hx.xci
+        self.yci = hx.yci
 
 class CakePiece(HexStructure):
     """ Cuts a angle defined piece from the hexagonal structure """
     def __init__(self, angle=np.pi/6.0, **kwargs):
-	""" hwat """
-	HexStructure.__init__(self, **kwargs)
-	# Cut unwanted positions away from the structure
-	new_xi = []
-	new_yi = []
-	for x, y in zip(self.xci, self.yci):
-	    phi = np.arctan2(y, x)
-	    # TODO refactor the angle out
-	    if 0 < phi < angle:
-		new_xi.append(x)
-		new_yi.append(y)
-
-	# Switch
-	self.xci = new_xi
-	self.yci = new_yi
+        """ hwat """
+        HexStructure.__init__(self, **kwargs)
+        # Cut unwanted positions away from the structure
+        phi = np.arctan2(self.yci, self.xci)
+        # TODO refactor the angle out
+        keep = (0 < phi) & (phi < angle)
+
+        # Switch
+        self.xci = self.xci[keep]
+        self.yci = self.yci[keep]
 
 class FromFile(LensStructure):
     """ Reads capillary positions from a file """
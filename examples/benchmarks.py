@@ -0,0 +1,473 @@
+""" Timing of the performance critical parts of lens simulations.
+Run from the repository root:
+console$: python -m examples.benchmarks """
+import matplotlib as mpl
+mpl.use('Agg')
+
+import time
+import numpy as np
+
+from lenses import bendshapes as bs
+from lenses import polycapillary as pl
+from elements import structures as st
+
+# Lens type 'A' settings, see lenses.polycapillary.PolyCurveLens
+_y_settings = {'y0': 0.0, 'y1': 40.0, 'y2': 140.0, 'yf': 155.0, 'ym': 88.0}
+_D_settings = {'Din': 4.5, 'Dmax': 8.0, 'Dout': 2.4}
+
+def timeit(function, *args, **kwargs):
+    """ Returns wall time of a single call in seconds """
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+def bench_bend_coefficients(bend = bs.capillary_curvature,
+                            sizes = [10**3, 10**4, 10**5, 10**6]):
+    """ Per-capillary bend function calls vs one batched call """
+    print 'Bend coefficients of {} [s]'.format(bend.__name__)
+    print '{:>10} {:>12} {:>12}'.format('channels', 'loop', 'batch')
+    for size in sizes:
+        radii = np.random.uniform(-2.25, 2.25, size)
+
+        # Python loop is hopeless for the biggest lenses
+        if size <= 10**5:
+            t_loop = timeit(lambda: [bend(r, _y_settings, _D_settings)
+                                     for r in radii])
+        else:
+            t_loop = np.nan
+
+        t_batch = timeit(bs.bend_coefficients,
+                         bend, radii, _y_settings, _D_settings)
+        print '{:>10} {:>12.4f} {:>12.4f}'.format(size, t_loop, t_batch)
+
+def bench_lens_construction(nx_capillaries = [3, 5, 9, 15]):
+    """ PolyCapillaryLens.make_capillaries time vs channel count """
+    print 'Lens construction [s]'
+    print '{:>10} {:>12}'.format('channels', 'time')
+    for nx in nx_capillaries:
+        structure = st.HexStructure(rIn = 0.005,
+                                    nx_capillary = nx,
+                                    ny_bundle = 3)
+        lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                    D_settings = _D_settings)
+        lens.set_structure(structure)
+        elapsed = timeit(lens.make_capillaries)
+        print '{:>10} {:>12.4f}'.format(len(structure.xci), elapsed)
+
+def bench_bank_construction(nx_capillaries = [3, 5, 9, 15, 31]):
+    """ PolyCapillaryLens.make_bank time and memory vs channel count """
+    print 'Capillary bank construction'
+    print '{:>10} {:>12} {:>12}'.format('channels', 'time [s]', 'size [MB]')
+    for nx in nx_capillaries:
+        structure = st.HexStructure(rIn = 0.005,
+                                    nx_capillary = nx,
+                                    ny_bundle = 3)
+        lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                    D_settings = _D_settings)
+        lens.set_structure(structure)
+        elapsed = timeit(lens.make_bank)
+        size = lens.bank.nbytes() / 1e6
+        print '{:>10} {:>12.4f} {:>12.3f}'.format(len(lens.bank),
+                                                  elapsed, size)
+
+def _powers(p, s):
+    """ Explicit powers evaluation (pre-Horner reference) """
+    return p[0] + p[1]*s + p[2]*s**2 + p[3]*s**3 + p[4]*s**4 + p[5]*s**5
+
+def bench_surface_evaluation(nrays = 10**6, repeats = 10):
+    """ Capillary surface evaluation cost in ns per ray """
+    structure = st.Singular(xin = 1.0, zin = 0.0)
+    lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                D_settings = _D_settings)
+    lens.set_structure(structure)
+    lens.make_bank()
+    capillary = lens.bank[0]
+
+    s = np.random.uniform(_y_settings['y1'], _y_settings['y2'], nrays)
+    phi = np.random.uniform(-np.pi, np.pi, nrays)
+    buff = np.empty_like(s)
+
+    cases = [('x0 powers', lambda: _powers(capillary.p, s)),
+             ('x0 horner', lambda: bs.horner(capillary.p, s)),
+             ('x0 horner out=', lambda: bs.horner(capillary.p, s, buff)),
+             ('x0 and x0Prime', lambda: bs.horner_with_derivative(
+                 capillary.p, s)),
+             ('local_r', lambda: capillary.local_r(s, phi)),
+             ('local_n', lambda: capillary.local_n(s, phi))]
+
+    print 'Surface evaluation [ns/ray]'
+    for name, case in cases:
+        elapsed = min(timeit(case) for _ in range(repeats))
+        print '{:>16} {:>10.2f}'.format(name, 1e9 * elapsed / nrays)
+
+def bench_straight_tracing(nrays = 10**5):
+    """ Closed-form vs generic tracing of straight and tapered capillaries """
+    from elements import capillary as ec
+    import xrt.backends.raycing as raycing
+    import xrt.backends.raycing.sources as rs
+
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(beamLine, 'source', (0, 39, 0),
+                                nrays = nrays,
+                                distx = 'flat', dx = 0.25,
+                                distz = 'flat', dz = 0.25,
+                                distxprime = 'flat', dxprime = 0.005,
+                                distzprime = 'flat', dzprime = 0.005,
+                                distE = 'lines', energies = (9000,),
+                                polarization = None)
+    beam = source.shine()
+
+    capillaries = [pl.StraightCapillary(beamLine, 'straight',
+                                        y_entrance = 40, y_outrance = 140,
+                                        R_in = 0.5, material = ec.mGlass),
+                   pl.LinearlyTapered(beamLine, 'tapered',
+                                      y_entrance = 40, y_outrance = 140,
+                                      R_in = 0.5, R_out = 0.1,
+                                      material = ec.mGlass)]
+
+    print 'Straight capillary tracing [s]'
+    print '{:>12} {:>12} {:>12}'.format('shape', 'generic', 'analytic')
+    for capillary in capillaries:
+        times = []
+        # Generic is xrt's own parametric-surface loop
+        capillary.compacted = False
+        for analytic in [False, True]:
+            capillary.analytic = analytic
+            times.append(timeit(capillary.multiple_reflect,
+                                beam, maxReflections = 50))
+        print '{:>12} {:>12.4f} {:>12.4f}'.format(capillary.name, *times)
+
+def bench_profile_tables(tolerances = [1e-5, 1e-7, 1e-9], nrays = 10**6):
+    """ Accuracy and speed of tabulated vs exact capillary profiles """
+    structure = st.Singular(xin = 2.0, zin = 0.0)
+    lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                D_settings = _D_settings)
+    lens.set_structure(structure)
+
+    s = np.random.uniform(_y_settings['y1'], _y_settings['y2'], nrays)
+    phi = np.random.uniform(-np.pi, np.pi, nrays)
+
+    print 'Profile tables: local_r + local_n'
+    print '{:>10} {:>10} {:>12} {:>12} {:>12}'.format('tolerance', 'nodes',
+                                                      'error [mm]',
+                                                      'exact [ns]',
+                                                      'table [ns]')
+    for tolerance in tolerances:
+        lens.set_profile_tolerance(tolerance)
+        lens.make_bank()
+        capillary = lens.bank[0]
+
+        def evaluate():
+            return capillary.local_r(s, phi), capillary.local_n(s, phi)
+
+        capillary.use_table = False
+        t_exact = timeit(evaluate)
+        r_exact = capillary.local_r(s, phi)
+        capillary.use_table = True
+        t_table = timeit(evaluate)
+        error = np.abs(capillary.local_r(s, phi) - r_exact).max()
+
+        print '{:>10.0e} {:>10} {:>12.2e} {:>12.2f} {:>12.2f}'.format(
+            tolerance, capillary.table.s.size, error,
+            1e9 * t_exact / nrays, 1e9 * t_table / nrays)
+
+def bench_structure_generation(nx_capillaries = [5, 11, 21, 41],
+                               ny_bundles = [3, 7, 11]):
+    """ HexStructure generation time vs its size """
+    print 'HexStructure generation'
+    print '{:>6} {:>6} {:>10} {:>12}'.format('nx', 'ny', 'channels',
+                                             'time [s]')
+    for ny in ny_bundles:
+        for nx in nx_capillaries:
+            start = time.time()
+            structure = st.HexStructure(rIn = 0.005,
+                                        nx_capillary = nx,
+                                        ny_bundle = ny)
+            elapsed = time.time() - start
+            print '{:>6} {:>6} {:>10} {:>12.4f}'.format(nx, ny,
+                                                        structure.xci.size,
+                                                        elapsed)
+
+def _random_beam(nrays):
+    """ Beam with all stored columns filled """
+    import xrt.backends.raycing.sources as rs
+
+    beam = rs.Beam(nrays = nrays)
+    for column in ['x', 'y', 'z', 'a', 'b', 'c', 'path', 'E']:
+        setattr(beam, column, np.random.random(nrays))
+    beam.state = np.ones(nrays, dtype = np.int32)
+    beam.Jss = np.random.random(nrays)
+    beam.Jpp = np.random.random(nrays)
+    beam.Jsp = beam.Jss + 1j * beam.Jpp
+    beam.nRefl = np.random.randint(0, 50, nrays)
+    return beam
+
+def bench_beam_storage(nrays = 1000, writes = [10, 100, 1000]):
+    """ Write and read throughput of csv vs binary beam files,
+    one write per traced capillary, as in setups.firstlens """
+    import shutil
+    import tempfile
+    from utils import beam as ub
+
+    beam = _random_beam(nrays)
+
+    print 'Beam storage [Mrays/s]'
+    print '{:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('rays',
+                                                             'csv w',
+                                                             'csv r',
+                                                             'binary w',
+                                                             'binary r',
+                                                             'mapped r')
+    for howmany in writes:
+        rates = []
+        for Writer, name in [(ub.CsvWriter, 'process1.csv'),
+                             (ub.BeamWriter, 'process1' + ub.BINARY_SUFFIX)]:
+            folder = tempfile.mkdtemp()
+            try:
+                def write():
+                    writer = Writer(folder + '/' + name)
+                    for _ in range(howmany):
+                        writer.write(beam)
+                    writer.close()
+                total = 1e-6 * nrays * howmany
+                rates.append(total / timeit(write))
+                rates.append(total / timeit(ub.load_beam, folder))
+            finally:
+                shutil.rmtree(folder)
+
+        # Mapped beams read only the columns in use
+        folder = tempfile.mkdtemp()
+        try:
+            writer = ub.BeamWriter(folder + '/process1' + ub.BINARY_SUFFIX)
+            for _ in range(howmany):
+                writer.write(beam)
+            writer.close()
+            def read_mapped():
+                mapped = ub.load_beam(folder, mapped = True)
+                return mapped.x.sum()
+            rates.append(1e-6 * nrays * howmany / timeit(read_mapped))
+        finally:
+            shutil.rmtree(folder)
+
+        print '{:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            nrays * howmany, *rates)
+
+def bench_beam_filtering(nrays = 10**7, fractions = [0.1, 0.5, 0.9]):
+    """ Filtering big beams: copy_by_index vs in place compact_beam """
+    from utils import beam as ub
+
+    print 'Beam filtering of {} rays'.format(nrays)
+    print '{:>10} {:>12} {:>12} {:>12}'.format('kept', 'copy [s]',
+                                               'compact [s]', 'copy [MB]')
+    for fraction in fractions:
+        beam = _random_beam(nrays)
+        mask = beam.x < fraction
+
+        t_copy = timeit(ub.copy_by_index, beam, mask)
+        t_compact = timeit(ub.compact_beam, beam, mask)
+
+        # Memory of the second set of arrays copy_by_index allocates
+        size = sum(getattr(beam, column).itemsize
+                   for column in ub.beam_columns(beam))
+        size *= 1e-6 * mask.sum()
+        print '{:>10.1f} {:>12.4f} {:>12.4f} {:>12.1f}'.format(fraction,
+                                                               t_copy,
+                                                               t_compact,
+                                                               size)
+
+def bench_bank_tracing(nx_capillary = 5, nrays = 100, loop_channels = 20):
+    """ One trace_bank call for all capillaries of a lens vs
+    the per-capillary loop of multiple_reflect, in rays/s """
+    import xrt.backends.raycing.sources as rs
+    from lenses import tracing as tr
+    from utils import beam as ub
+
+    structure = st.HexStructure(rIn = 0.005,
+                                nx_capillary = nx_capillary,
+                                ny_bundle = 3)
+    lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                D_settings = _D_settings)
+    lens.set_structure(structure)
+    lens.make_bank()
+    bank = lens.bank
+
+    # Rays just before every entrance, inside of it
+    howmany = len(bank) * nrays
+    channel = np.repeat(np.arange(len(bank)), nrays)
+    radius = 0.5 * bank.R_in[channel]
+    beam = rs.Beam(nrays = howmany)
+    shift = np.random.uniform(-1, 1, (2, howmany)) * radius
+    beam.x = bank.x_entrance[channel] + shift[0]
+    beam.z = bank.z_entrance[channel] + shift[1]
+    beam.y = bank.y_entrance[channel] - 1.0
+    beam.a = np.random.uniform(-1e-3, 1e-3, howmany)
+    beam.c = np.random.uniform(-1e-3, 1e-3, howmany)
+    beam.b = np.sqrt(1 - beam.a**2 - beam.c**2)
+    beam.state = np.ones(howmany, dtype = np.int32)
+    beam.E = np.ones(howmany) * 9000
+
+    # Python loop only over a part of the lens
+    def loop():
+        for k in range(loop_channels):
+            part = np.arange(k * nrays, (k + 1) * nrays)
+            bank[k].multiple_reflect(ub.copy_by_index(beam, part),
+                                     maxReflections = 550)
+    t_loop = timeit(loop)
+    t_bank = timeit(tr.trace_bank, bank, beam, channel, maxReflections = 550)
+
+    print 'Bank tracing of {} channels [rays/s]'.format(len(bank))
+    print '{:>12} {:>12}'.format('loop', 'trace_bank')
+    print '{:>12.0f} {:>12.0f}'.format(loop_channels * nrays / t_loop,
+                                       howmany / t_bank)
+
+def bench_active_compaction(nrays = 10**5, compactions = [0, 0.25, 0.5]):
+    """ Reflection loop of a tapered capillary, where a long tail
+    of rays bounces hundreds of times, with and without compaction
+    of the active rays (see lenses.tracing.ActiveRays), and of a
+    bent capillary with xrt's loop vs the compacted one """
+    from elements import capillary as ec
+    import xrt.backends.raycing as raycing
+    import xrt.backends.raycing.sources as rs
+    from lenses import tracing as tr
+
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(beamLine, 'source', (0, 39, 0),
+                                nrays = nrays,
+                                distx = 'flat', dx = 0.25,
+                                distz = 'flat', dz = 0.25,
+                                distxprime = 'flat', dxprime = 0.01,
+                                distzprime = 'flat', dzprime = 0.01,
+                                distE = 'lines', energies = (9000,),
+                                polarization = None)
+    beam = source.shine()
+    capillary = pl.LinearlyTapered(beamLine, 'tapered',
+                                   y_entrance = 40, y_outrance = 140,
+                                   R_in = 0.5, R_out = 0.1,
+                                   material = ec.mGlass)
+
+    print 'Active ray compaction, {} rays'.format(nrays)
+    print '{:>12} {:>12} {:>12} {:>12}'.format('compaction', 'time [s]',
+                                               'iterations', 'last active')
+    for compaction in compactions:
+        counter = []
+        elapsed = timeit(tr.trace_cone, capillary, beam,
+                         maxReflections = 550,
+                         compaction = compaction, counter = counter)
+        print '{:>12} {:>12.4f} {:>12} {:>12}'.format(compaction, elapsed,
+                                                      len(counter),
+                                                      counter[-1])
+
+    # Bent capillaries can opt in to the same compacted
+    # loop (tracing.trace_capillary) instead of xrt's
+    structure = st.Singular(xin = 1.0, zin = 0.0, rIn = 0.005)
+    lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                D_settings = _D_settings,
+                                material = ec.mGlass)
+    lens.set_structure(structure)
+    bent = lens.get_capillaries()[0]
+    hitpoint = (bent.entrance_x(), 39.99, bent.entrance_z())
+    source = rs.GeometricSource(beamLine, 'bent source', hitpoint,
+                                nrays = nrays,
+                                distx = 'flat', dx = 0.0025,
+                                distz = 'flat', dz = 0.0025,
+                                distxprime = 'flat', dxprime = 0.001,
+                                distzprime = 'flat', dzprime = 0.001,
+                                distE = 'lines', energies = (9000,),
+                                polarization = None)
+    beam = source.shine()
+
+    print 'Bent capillary multiple_reflect [s]'
+    print '{:>12} {:>12}'.format('xrt loop', 'compacted')
+    times = []
+    for compacted in [False, True]:
+        bent.compacted = compacted
+        times.append(timeit(bent.multiple_reflect, beam,
+                            maxReflections = 550))
+    print '{:>12.4f} {:>12.4f}'.format(*times)
+
+def bench_source_generation(entrances = [100, 1000, 10000], nrays = 100):
+    """ FitGeometricSource: shine per entrance vs one shine_many """
+    import xrt.backends.raycing as raycing
+    from elements import sources as es
+
+    beamLine = raycing.BeamLine()
+    source = es.FitGeometricSource(beamLine, 'Fitted', (0, 39.99, 0),
+                                   nrays = nrays,
+                                   distx = 'flat', dx = 0.005,
+                                   distxprime = 'flat', dxprime = 0.001,
+                                   distz = 'flat', dz = 0.005,
+                                   distzprime = 'flat', dzprime = 0.001,
+                                   distE = 'normal', energies = (9000, 100),
+                                   polarization = None)
+
+    print 'Fitted source generation of {} rays per entrance [s]'.format(nrays)
+    print '{:>10} {:>12} {:>12}'.format('entrances', 'shine', 'shine_many')
+    for howmany in entrances:
+        hitpoints = np.zeros((howmany, 3))
+        hitpoints[:, 0] = np.random.uniform(-2.25, 2.25, howmany)
+        hitpoints[:, 1] = _y_settings['y1']
+        hitpoints[:, 2] = np.random.uniform(-2.25, 2.25, howmany)
+
+        t_loop = timeit(lambda: [source.shine(hitpoint)
+                                 for hitpoint in hitpoints])
+        t_many = timeit(source.shine_many, hitpoints, nrays)
+        print '{:>10} {:>12.4f} {:>12.4f}'.format(howmany, t_loop, t_many)
+
+def bench_importance_sampling(nrays = 1000, fractions = [None, 0.5, 0.9]):
+    """ Transmitted rays per second and weighted transmission of a
+    lens for plain and acceptance-cone importance sampled sources """
+    from elements import capillary as ec
+    from lenses import tracing as tr
+    from setups import firstlens as fl
+
+    structure = st.HexStructure(rIn = 0.005, nx_capillary = 3, ny_bundle = 3)
+    lens = pl.PolyCapillaryLens(y_settings = _y_settings,
+                                D_settings = _D_settings,
+                                material = ec.mGlass)
+    lens.set_structure(structure)
+    bank = lens.get_capillaries(bank = True)
+
+    setup = fl.MultipleCapillariesFittedSource()
+    setup.set_capillaries(bank)
+    setup.set_dxprime(0.02)
+    setup.set_dzprime(0.02)
+    setup.set_nrays(nrays)
+
+    hitpoints = np.column_stack([bank.x_entrance, bank.y_entrance,
+                                 bank.z_entrance])
+
+    print 'Importance sampling, {} rays per capillary'.format(nrays)
+    print '{:>10} {:>14} {:>14}'.format('fraction', 'good [rays/s]',
+                                        'transmission')
+    for fraction in fractions:
+        setup.set_importance(fraction)
+        setup.make_source()
+
+        start = time.time()
+        light = setup.source.shine_many(hitpoints, nrays)
+        beam, _ = tr.trace_bank(bank, light, light.channel,
+                                maxReflections = 550)
+        elapsed = time.time() - start
+
+        # Intensities carry the weights
+        good = (beam.state == 1) | (beam.state == 2)
+        transmission = (beam.Jss + beam.Jpp)[good].sum() / light.state.size
+        print '{:>10} {:>14.0f} {:>14.4f}'.format(fraction,
+                                                  good.sum() / elapsed,
+                                                  transmission)
+
+if __name__ == '__main__':
+    bench_bend_coefficients(bs.capillary_curvature)
+    bench_bend_coefficients(bs.parabolic_curvature)
+    bench_lens_construction()
+    bench_bank_construction()
+    bench_surface_evaluation()
+    bench_straight_tracing()
+    bench_profile_tables()
+    bench_structure_generation()
+    bench_beam_storage()
+    bench_beam_filtering()
+    bench_bank_tracing()
+    bench_active_compaction()
+    bench_source_generation()
+    bench_importance_sampling()
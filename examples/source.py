@@ -14,13 +14,15 @@ import xrt.plotter as xrtp
 import xrt.backends.raycing.run as rr
 import xrt.backends.raycing as raycing
 
+from utils import beam as ub
+
 class GeometricSourceTest(object):
     """ Implements methods for easy observations of chosen source """
     def __init__(self):
         """ Co robi traktor u fryzjera? Warkocze """
 
-        # Testing new functionality
-        self.beamTotal = None
+        # Photons of all runs (see utils.beam.BeamAccumulator)
+        self.beamTotal = ub.BeamAccumulator()
 
         # Physical end of the source
         self.y_outrance = 1
@@ -89,12 +91,15 @@ class GeometricSourceTest(object):
 
     def get_beam(self):
         """ Get beamLine object holding all photon data """
-        return self.beamTotal
+        return self.beamTotal.finalize()
 
     def run_it(self):
         """ Runs the whole operation """
         self.make_it()
 
+        # Number of photons is known upfront
+        self.beamTotal.reserve(self.repeats * self.nrays)
+
         # 
         xrtr.run_ray_tracing(self.plots,\
                             repeats=self.repeats,\
@@ -115,10 +120,7 @@ class GeometricSourceTest(object):
             beamSource = beamLine.sources[0].shine()
 
             # Hold photons for export
-            if self.beamTotal is None:
-                self.beamTotal = beamSource
-            else:
-                self.beamTotal.concatenate(beamSource)
+            self.beamTotal.append(beamSource)
 
             # Use those screens for testing parameters
             exitScreen = beamLine.exitScreen.expose(beamSource)
@@ -1,6 +1,4 @@
 import numpy as np
-from sympy import poly
-from sympy.abc import x as XX
 import matplotlib.pyplot as plt
 
 """
@@ -13,86 +11,94 @@ provided parameters
 def capillary_curvature(x, y, D):
     """ Calculates capillary curvature for distance x from
     the center and other lens properties described in y and D """
-    y0 = y['y0']
+    # Single capillary is just a batch of one
+    p = capillary_curvature_batch([x], y, D)
+    return p[0]
+
+def curvature_matrix(y):
+    """ Left hand side of the A*p = B system, it depends only
+    on the y-settings so it is shared by every capillary of a lens """
     y1 = y['y1']
     ym = y['ym']
     y2 = y['y2']
+    # Rows are in the same order as in curvature_rhs
+    a = [shape_coeffs(y1),
+         shape_coeffs(y2),
+         shape_coeffs(ym),
+         diff_coeffs(y1),
+         diff_coeffs(y2),
+         diff_coeffs(ym)]
+    return np.array(a)
+
+def curvature_rhs(x, y, D):
+    """ Right hand side of the A*p = B system for an array
+    of entrance radii x, returns (6, N) array """
+    y0 = y['y0']
+    y1 = y['y1']
+    y2 = y['y2']
     yf = y['yf']
-    h1 = x
+    h1 = np.asarray(x, dtype=float).ravel()
     Din     = D['Din']
     Dout    = D['Dout']
     Dmax    = D['Dmax']
     h2 = h1 * Dout/Din
     hm = 0.5*Dmax * h1/(Din/2.)
-    # y(x) = p0 + p1 x + p2 x**2 + p3 x**3 + p4 x**4 + p5 x**5
-    a = []
-    b = []
-    # Preparing A*p = B matrices for linalg.solve 
     # y(y1) == h1
-    a.append(shape_coeffs(y1))
-    b.append(h1)
     # y(y2) == h2
-    a.append(shape_coeffs(y2))
-    b.append(h2)
     # y(ym) == hm
-    a.append(shape_coeffs(ym))
-    b.append(hm)
-    # y'(y1) == S1'(y1)
-    # first find left slope
+    # y'(y1) == S1'(y1), left slope
     s1 = h1 / (y1 - y0)
-    a.append(diff_coeffs(y1))
-    b.append(s1)
     # y'(y2) == S2'(x)
     s2 = -h2 / (yf - y2)
-    a.append(diff_coeffs(y2))
-    b.append(s2)
     # y'(ym) == 0
-    a.append(diff_coeffs(ym))
-    b.append(0.)
+    b = [h1, h2, hm, s1, s2, np.zeros_like(h1)]
+    return np.array(b)
+
+def capillary_curvature_batch(x, y, D):
+    """ Vectorized capillary_curvature: *x* is an array of
+    entrance radii, returns (N, 6) array of coefficients """
+    # y(x) = p0 + p1 x + p2 x**2 + p3 x**3 + p4 x**4 + p5 x**5
+    a = curvature_matrix(y)
+    b = curvature_rhs(x, y, D)
+    # One factorization for all of the right hand sides
     p = np.linalg.solve(a, b)
-    return p
+    # Keep rows contiguous, one row per capillary
+    return np.ascontiguousarray(p.T)
 
 def parabolic_curvature(x, y, D):
     """ Another model of capillarian bend is described here """
-    # Those are generic lens describing parameters
-    # and may be used to describe the curve
-    y0 = y['y0']
-    y1 = y['y1']
-    ym = y['ym']
-    y2 = y['y2']
-    yf = y['yf']
-    h1 = abs(x)
+    # Single capillary is just a batch of one
+    p = parabolic_curvature_batch([x], y, D)
+
+    # Convert to floats
+    out = [float(val) for val in p[0]]
+
+    return out
+
+def parabolic_curvature_batch(x, y, D):
+    """ Vectorized parabolic_curvature: *x* is an array of
+    entrance radii, returns (N, 6) array of coefficients """
+    # Only the entrance diameter is used by this model
+    h1 = np.abs(np.asarray(x, dtype=float).ravel())
     Din     = D['Din']
-    Dout    = D['Dout']
-    Dmax    = D['Dmax']
-    h2 = h1 * Dout/Din
-    hm = h1 * (0.5 * Dmax) / (0.5 * Din)
 
-    # TODO lambdas might look better?
-    # Define a specific parabola with y(40) = 1
+    # Define a specific parabola with y(40) = 1:
+    # funn(pos) = 1 - (pos/85.5 - 1)**2 = 2/85.5 pos - 1/85.5**2 pos**2
+    apex = 85.5
     def funn(pos):
-        return 1. - (pos/85.5 - 1.) **2
+        return 1. - (pos/apex - 1.) **2
 
     # Normalize to the type 'A' lens entrance
     # and account for amplitude :: x/Din
-    def fuxx(pos):
-        return (1. * h1 / Din) * funn(pos) / funn(40)
-
-    # Make it sympy.poly(x)
-    if h1 <> 0:
-        parapoly = poly(fuxx(XX))
-        coeffs = parapoly.all_coeffs()
-    else:
-        coeffs = [0., 0., 0.]
+    amplitude = (1. * h1 / Din) / funn(40)
 
-    # Reverse coefficients so they start with the lowest power
-    coeffs.reverse()
-    out = coeffs + [0., 0., 0.]
+    # Coefficients start with the lowest power,
+    # h1 == 0 gives a straight capillary
+    p = np.zeros((h1.size, 6))
+    p[:, 1] = 2. * amplitude / apex
+    p[:, 2] = -1. * amplitude / apex**2
 
-    # Convert to floats
-    out = [float(val) for val in out]
-
-    return out
+    return p
 
 def shape_coeffs(x):
     """ This method is poorly named """
@@ -104,6 +110,143 @@ def diff_coeffs(x):
     coeff_array = [0., 1., 2 * x, 3 * x**2, 4 * x**3, 5 * x**4]
     return coeff_array
 
+def _degree(p):
+    """ Highest power with a non-zero coefficient """
+    degree = len(p) - 1
+    while degree > 0 and np.all(p[degree] == 0):
+        degree -= 1
+    return degree
+
+def _output(s, out):
+    """ Prepare output buffer of the *s* shape """
+    if out is None:
+        out = np.empty(np.shape(s), dtype=float)
+    return out
+
+def _result(out):
+    """ Scalars in, scalars out """
+    if out.ndim == 0:
+        return out[()]
+    return out
+
+def horner(p, s, out = None):
+    """ Evaluates p[0] + p[1]*s + p[2]*s**2 + ... with the Horner
+    scheme, without temporary arrays. Coefficients may also be
+    arrays broadcastable with *s* (one polynomial per ray) """
+    out = _output(s, out)
+    degree = _degree(p)
+    out[...] = p[degree]
+    for k in range(degree - 1, -1, -1):
+        np.multiply(out, s, out=out)
+        np.add(out, p[k], out=out)
+    return _result(out)
+
+def horner_derivative(p, s, out = None):
+    """ Evaluates derivative of the p polynomial at *s* """
+    out = _output(s, out)
+    degree = _degree(p)
+    if degree == 0:
+        out[...] = 0.
+        return _result(out)
+    out[...] = degree * p[degree]
+    for k in range(degree - 1, 0, -1):
+        np.multiply(out, s, out=out)
+        np.add(out, k * p[k], out=out)
+    return _result(out)
+
+def horner_with_derivative(p, s, out = None, dout = None):
+    """ Value and derivative of the p polynomial in one pass """
+    out = _output(s, out)
+    dout = _output(s, dout)
+    degree = _degree(p)
+    out[...] = p[degree]
+    dout[...] = 0.
+    for k in range(degree - 1, -1, -1):
+        # d = d*s + b, b = b*s + p[k]
+        np.multiply(dout, s, out=dout)
+        np.add(dout, out, out=dout)
+        np.multiply(out, s, out=out)
+        np.add(out, p[k], out=out)
+    return _result(out), _result(dout)
+
+def derivative_coeffs(p):
+    """ Coefficients of the derivative polynomial """
+    return [k * p[k] for k in range(1, len(p))] or [0.]
+
+class ProfileTable(object):
+    """ Capillary center x0, radius r0 and their derivatives
+    tabulated on a regular s-grid for linear interpolation.
+    For the 5th degree bend polynomials Horner is still faster
+    (see examples.benchmarks.bench_profile_tables), tables pay
+    off only for profiles expensive to evaluate """
+    def __init__(self, p, pr, s_min, s_max, tolerance = 1e-7,
+                 max_size = 10**6):
+        """ Grid is fine enough to keep the interpolation
+        error of every tabulated function below *tolerance* """
+        self.tolerance = tolerance
+
+        # Linear interpolation error is below h**2/8 * max|f''|
+        probe = np.linspace(s_min, s_max, 10001)
+        curvature = 0.
+        for coeffs in [p, pr]:
+            second = derivative_coeffs(derivative_coeffs(coeffs))
+            third = derivative_coeffs(second)
+            for c in [second, third]:
+                curvature = max(curvature, np.abs(horner(c, probe)).max())
+
+        if curvature > 0:
+            h = np.sqrt(8. * tolerance / curvature)
+            size = int(np.ceil((s_max - s_min) / h)) + 1
+        else:
+            size = 2
+        size = min(max(size, 2), max_size)
+
+        self.s = np.linspace(s_min, s_max, size)
+        self.x0, self.x0Prime = horner_with_derivative(p, self.s)
+        self.r0, self.r0Prime = horner_with_derivative(pr, self.s)
+
+    # Tabulated arrays
+    columns = ['s', 'x0', 'x0Prime', 'r0', 'r0Prime']
+
+    @classmethod
+    def from_arrays(cls, tolerance, **arrays):
+        """ Table with given (e.g. memory-mapped) nodes and values """
+        table = cls.__new__(cls)
+        table.tolerance = tolerance
+        for column in cls.columns:
+            setattr(table, column, arrays[column])
+        return table
+
+    def locate(self, s):
+        """ Node index and position between the nodes of every *s*,
+        the grid is regular so no search is needed """
+        size = self.s.size
+        s0, s1 = self.s[0], self.s[-1]
+        u = np.clip(s, s0, s1)
+        u -= s0
+        u *= (size - 1) / (s1 - s0)
+        ind = u.astype(np.intp)
+        np.minimum(ind, size - 2, out = ind)
+        u -= ind
+        return ind, u
+
+    def interpolate(self, values, s):
+        """ Values at *s*, clamped to the ends of the table """
+        ind, u = self.locate(s)
+        low = values.take(ind)
+        return low + u * (values.take(ind + 1) - low)
+
+    def max_error(self, p, pr, size = 100001):
+        """ Largest difference between the table and the
+        exact polynomials, checked off the grid nodes """
+        s = np.linspace(self.s[0], self.s[-1], size)
+        pairs = [(self.x0, horner(p, s)),
+                 (self.x0Prime, horner_derivative(p, s)),
+                 (self.r0, horner(pr, s)),
+                 (self.r0Prime, horner_derivative(pr, s))]
+        return max(np.abs(self.interpolate(values, s) - exact).max()
+                   for values, exact in pairs)
+
 def radius_curvature(y, r):
     """ Use this to get polynomial coefficients for
     position dependant capillary radius """
@@ -118,6 +261,20 @@ def radius_curvature(y, r):
 
     return np.linalg.solve(A,B)
 
+# Bend functions with an array-in/array-out counterpart
+_batched = {capillary_curvature : capillary_curvature_batch,
+            parabolic_curvature : parabolic_curvature_batch}
+
+def bend_coefficients(bend, x, y, D):
+    """ Coefficients of *bend* for every entrance radius in *x*,
+    returns (N, 6) array. Unknown (custom) bend functions
+    are evaluated one capillary at a time """
+    if bend in _batched:
+        return _batched[bend](x, y, D)
+
+    p = [bend(h1, y, D) for h1 in np.asarray(x, dtype=float).ravel()]
+    return np.array(p, dtype=float).reshape(-1, 6)
+
 if __name__ == '__main__':
     """ python lenses/bendshapes.py """
     # y-parameters of a capillary
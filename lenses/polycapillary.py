@@ -1,5 +1,7 @@
+import os
 import numpy as np
 import bendshapes as bs
+import tracing as tr
 import matplotlib.pyplot as plt
 from elements import structures as st
 import xrt.backends.raycing as raycing
@@ -38,41 +40,84 @@ class Capillary(roe.OE):
         # radius rather then polar coordinate
         self.R_in = kwargs.pop('R_in', 1)
 
+        # Optional tabulated profile (see set_profile_table)
+        self.table = None
+        self.table_scale = 1.
+        self.use_table = False
+
+        # Opt-in reflection loop of lenses.tracing with compacted
+        # active rays, by default xrt's own loop is used
+        self.compacted = kwargs.pop('compacted', False)
+
         # Init parent class 
         roe.OE.__init__(self, *args, **kwargs)
         self.isParametric = True
 
+    def multiple_reflect(self, beam=None, maxReflections=1000, **kwargs):
+        """ xrt's loop, or with *compacted* set the capillary is traced
+        as a single bank (see tracing.trace_bank): faster, profile
+        tables are used as well, but the s-p frame is not rotated
+        between reflections and rays are returned at the exit plane
+        instead of their last reflection point. xrt's own loop
+        handles extra keyword arguments """
+        if self.compacted and not kwargs:
+            return tr.trace_capillary(self, beam, maxReflections)
+
+        return roe.OE.multiple_reflect(self, beam,
+                                       maxReflections, **kwargs)
+
+    def set_profile_table(self, table, scale = 1.):
+        """ Interpolate x0 (multiplied by *scale*) and r0 from
+        a bendshapes.ProfileTable instead of exact polynomials """
+        self.table = table
+        self.table_scale = scale
+        self.use_table = table is not None
+
     def local_x0(self, s):
         """ Center of the capillary """
-        return self.p[0] + self.p[1]*s + self.p[2]*s**2\
-                + self.p[3]*s**3 + self.p[4]*s**4 + self.p[5]*s**5
+        if self.use_table:
+            return self.table_scale * self.table.interpolate(self.table.x0, s)
+        return bs.horner(self.p, s)
 
     def local_x0Prime(self, s):
         """ Derivative of x0 """
-        return self.p[1] + 2*self.p[2]*s + 3*self.p[3]*s**2\
-                + 4*self.p[4]*s**3 + 5*self.p[5]*s**4
+        if self.use_table:
+            x0Prime = self.table.interpolate(self.table.x0Prime, s)
+            return self.table_scale * x0Prime
+        return bs.horner_derivative(self.p, s)
 
     def local_r0(self, s):
         """ Radius of the capillary (wall - x0 distance) """
-        return self.pr[0] + self.pr[1]*s + self.pr[2]*s**2
+        if self.use_table:
+            return self.table.interpolate(self.table.r0, s)
+        return bs.horner(self.pr, s)
 
     def local_r0Prime(self,s):
         """ Derivative of radius """
-        return self.pr[1] + 2*self.pr[2]*s
+        if self.use_table:
+            return self.table.interpolate(self.table.r0Prime, s)
+        return bs.horner_derivative(self.pr, s)
 
     def local_r(self, s, phi):
         """ ? """
         # FIXME - i still am not sure what is all of this doing
-        den = np.cos(np.arctan(self.local_x0Prime(s)))**2
-        return self.local_r0(s) / (np.cos(phi)**2/den + np.sin(phi)**2)
+        # r0 / (cos(phi)**2 / cos(arctan(x0'))**2 + sin(phi)**2)
+        # with cos(arctan(x0'))**2 == 1 / (1 + x0'**2) becomes
+        # r0 / (1 + (cos(phi) * x0')**2)
+        den = np.cos(phi) * self.local_x0Prime(s)
+        den *= den
+        den += 1
+        return self.local_r0(s) / den
 
     def local_n(self, s, phi):
         """ normal to the surface """
-        a = -np.sin(phi)
-        b = -np.sin(phi)*self.local_x0Prime(s) - self.local_r0Prime(s)
-        c = -np.cos(phi)
-        norm = np.sqrt(a**2 + b**2 + c**2)
-        return a/norm, -b/norm, c/norm
+        # (a, b, c) = (-sin(phi), -sin(phi)*x0' - r0', -cos(phi))
+        # so a**2 + c**2 == 1 and only -b has to be computed
+        sin_phi = np.sin(phi)
+        minus_b = sin_phi * self.local_x0Prime(s)
+        minus_b += self.local_r0Prime(s)
+        norm = np.sqrt(1. + minus_b**2)
+        return -sin_phi/norm, minus_b/norm, -np.cos(phi)/norm
 
     def xyz_to_param(self, x, y, z):
         """ *s*, *r*, *phi* are cylindrc-like coordinates of the capillary.
@@ -80,8 +125,9 @@ class Capillary(roe.OE):
         *r* is measured from the capillary axis x0(s)
         *phi* is the polar angle measured from the z (vertical) direction."""
         s = y
-        phi = np.arctan2(x - self.local_x0(s), z)
-        r = np.sqrt((x-self.local_x0(s))**2 + z**2)
+        dx = x - self.local_x0(s)
+        phi = np.arctan2(dx, z)
+        r = np.sqrt(dx**2 + z**2)
         return s, phi, r
 
     def param_to_xyz(self, s, phi, r):
@@ -111,6 +157,18 @@ class Capillary(roe.OE):
         """ Returns y-distance from the origin to the finish """
         return self.y_outrance
 
+    def reflection_estimate(self, divergence, samples = 32):
+        """ Rough number of reflections of a ray entering with
+        *divergence*, for balancing work between processes.
+        Bent wall forces a reflection every 4*sqrt(r0/x0'')
+        (chord of the bend), straight one every 2*r0/divergence """
+        p = np.asarray(self.p, dtype=float)[:, np.newaxis]
+        pr = np.asarray(self.pr, dtype=float)[:, np.newaxis]
+        estimate = reflection_estimates(p, pr, self.entrance_y(),
+                                        self.outrance_y(), divergence,
+                                        samples)
+        return estimate[0]
+
     def plot(self, show = True):
         """ Rather simplistic single capillary plotter """
         # Get positions
@@ -143,6 +201,10 @@ class StraightCapillary(Capillary):
     """ Implements straight capillary parallel to the beam """
     def __init__(self, *args, **kwargs):
         """ Constructor """
+        # Closed-form cylinder/cone tracing can be switched
+        # off to compare with the generic xrt path
+        self.analytic = kwargs.pop('analytic', True)
+
         # Init parent capillary class
         Capillary.__init__(self, *args, **kwargs)
 
@@ -154,6 +216,20 @@ class StraightCapillary(Capillary):
         # Same concept with radius
         self.pr = [self.R_in, 0, 0]
 
+    def is_analytic(self):
+        """ True if the wall is a cylinder or a cone """
+        straight = np.all(np.asarray(self.p[1:]) == 0)
+        linear = self.pr[2] == 0
+        return straight and linear
+
+    def multiple_reflect(self, beam=None, maxReflections=1000, **kwargs):
+        """ Uses closed-form wall intersections when possible """
+        if self.analytic and self.is_analytic() and not kwargs:
+            return tr.trace_cone(self, beam, maxReflections)
+
+        return Capillary.multiple_reflect(self, beam,
+                                          maxReflections, **kwargs)
+
 class LinearlyTapered(StraightCapillary):
     """ You have to set the radius coefficients yourself """
     def __init__(self, *args, **kwargs):
@@ -190,7 +266,11 @@ class BentCapillary(Capillary):
 
         # TODO We want to abstract this out
         bend = kwargs.pop('bend')
-        self.p = bend(r_in, y, D)
+        # Lens may provide coefficients solved for all capillaries at once
+        p = kwargs.pop('p', None)
+        if p is None:
+            p = bend(r_in, y, D)
+        self.p = p
 
         # FIXME - this is probably no longer necessary
         # Save cartesian coordinates of capillary entrance
@@ -201,10 +281,14 @@ class BentCapillary(Capillary):
         kwargs.update({'x_entrance' : self.x_entrance})
         kwargs.update({'z_entrance' : self.z_entrance})
 
-        # Prepare variable radius
+        # Prepare variable radius, lens may provide
+        # a profile shared by all of its capillaries
         r_settings = kwargs.pop('radius')
         radius_shape = kwargs.pop('radius_shape')
-        self.pr = radius_shape(y, r_settings)
+        pr = kwargs.pop('pr', None)
+        if pr is None:
+            pr = radius_shape(y, r_settings)
+        self.pr = pr
 
         # Init parent capillary class
         Capillary.__init__(self, *args, **kwargs)
@@ -214,6 +298,232 @@ class BentCapillary(Capillary):
         self.y_entrance = y['y1']
         self.y_outrance = y['y2']
 
+class CapillaryBank(object):
+    """ Compact representation of all capillaries of a lens,
+    Capillary objects are created only when asked for """
+    # Geometry arrays written by share
+    shared_columns = ['x_entrance', 'z_entrance', 'roll', 'p', 'pr',
+                      'y_entrance', 'y_outrance', 'R_in']
+
+    def __init__(self, beamLine, x_entrance, z_entrance, roll,
+                 p, pr, y_entrance, y_outrance, R_in, material = None):
+        """ Every per-capillary argument must be an array of length N
+        (p and pr of shape (N, 6) and (N, 3), or (3,) for a radius
+        profile shared by all capillaries), scalars are broadcast """
+        self.beamLine = beamLine
+        self.material = material
+
+        # Entrance position (roll is the polar angle, see BentCapillary)
+        self.x_entrance = np.ascontiguousarray(x_entrance, dtype=float)
+        self.z_entrance = np.ascontiguousarray(z_entrance, dtype=float)
+        self.roll = np.ascontiguousarray(roll, dtype=float)
+        howmany = self.x_entrance.size
+
+        # Polynomial coefficients, one row per capillary
+        self.p = np.ascontiguousarray(p, dtype=float).reshape(howmany, 6)
+
+        # Single radius profile (shape (3,)) is shared by all
+        # capillaries through a read-only, zero-stride view
+        pr = np.asarray(pr, dtype=float)
+        if pr.ndim == 1:
+            shared = pr.copy()
+            shared.flags.writeable = False
+            self.pr = np.broadcast_to(shared, (howmany, 3))
+        else:
+            self.pr = np.ascontiguousarray(pr).reshape(howmany, 3)
+
+        # Physical limits in the y-direction and entrance radius
+        self.y_entrance = self._per_capillary(y_entrance, howmany)
+        self.y_outrance = self._per_capillary(y_outrance, howmany)
+        self.R_in = self._per_capillary(R_in, howmany)
+
+        # Optional profile table shared by all capillaries
+        self.table = None
+        self.table_scale = None
+
+    @staticmethod
+    def _per_capillary(value, howmany):
+        """ Broadcast scalar settings to contiguous arrays,
+        arrays of the right size are used without copying """
+        value = np.asarray(value, dtype=float)
+        if value.shape == (howmany,):
+            return np.ascontiguousarray(value)
+
+        out = np.empty(howmany, dtype=float)
+        out[:] = value
+        return out
+
+    def __len__(self):
+        """ Number of capillaries """
+        return self.x_entrance.size
+
+    def __iter__(self):
+        """ Materializes capillaries one by one """
+        for it in xrange(len(self)):
+            yield self[it]
+
+    def __getitem__(self, it):
+        """ Single Capillary sharing coefficients with the bank """
+        if it < 0:
+            it += len(self)
+        if not 0 <= it < len(self):
+            raise IndexError('capillary index out of range')
+
+        capillary = Capillary(self.beamLine, 'bent', [0, 0, 0],
+                              x_entrance = self.x_entrance[it],
+                              z_entrance = self.z_entrance[it],
+                              y_entrance = self.y_entrance[it],
+                              y_outrance = self.y_outrance[it],
+                              R_in = self.R_in[it],
+                              material = self.material)
+
+        # The bank, not the BeamLine, owns the geometry: do not let
+        # short-lived views pile up in the BeamLine registry
+        if capillary in self.beamLine.oes:
+            self.beamLine.oes.remove(capillary)
+
+        # Row views, no copies
+        capillary.p = self.p[it]
+        capillary.pr = self.pr[it]
+
+        if self.table is not None:
+            capillary.set_profile_table(self.table, self.table_scale[it])
+
+        return capillary
+
+    def set_profile_table(self, table, scale):
+        """ One ProfileTable for all capillaries, x0 of each
+        capillary is the tabulated one times its *scale* """
+        self.table = table
+        if table is None:
+            self.table_scale = None
+        else:
+            self.table_scale = self._per_capillary(scale, len(self))
+
+    def share(self, folder):
+        """ Writes the geometry to .npy files inside *folder*
+        for other processes to attach to (see attach) """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        for column in self.shared_columns:
+            values = getattr(self, column)
+            # Shared radius profile is stored only once
+            if values.ndim == 2 and values.strides[0] == 0:
+                values = values[0]
+            np.save(os.path.join(folder, column + '.npy'), values)
+
+        if self.table is not None:
+            np.save(os.path.join(folder, 'table_scale.npy'), self.table_scale)
+            np.save(os.path.join(folder, 'table_tolerance.npy'),
+                    self.table.tolerance)
+            for column in self.table.columns:
+                values = getattr(self.table, column)
+                np.save(os.path.join(folder, 'table_' + column + '.npy'),
+                        values)
+
+    @staticmethod
+    def attach(beamLine, folder, material = None):
+        """ Bank with geometry mapped read-only from the files
+        written by share: every process attached to the same
+        folder uses one copy of it (the OS page cache) """
+        def load(name):
+            path = os.path.join(folder, name + '.npy')
+            return np.load(path, mmap_mode='r')
+
+        arrays = dict((column, load(column))
+                      for column in CapillaryBank.shared_columns)
+        bank = CapillaryBank(beamLine, material = material, **arrays)
+
+        if os.path.isfile(os.path.join(folder, 'table_scale.npy')):
+            tolerance = float(load('table_tolerance'))
+            columns = dict((column, load('table_' + column))
+                           for column in bs.ProfileTable.columns)
+            table = bs.ProfileTable.from_arrays(tolerance, **columns)
+            bank.set_profile_table(table, load('table_scale'))
+
+        return bank
+
+    def entrance_radius(self):
+        """ Entrance radius of the first capillary (setup fitting) """
+        return self.R_in[0]
+
+    def entrance_y(self):
+        """ Returns y-distance from the origin to the beginning """
+        return self.y_entrance[0]
+
+    def outrance_y(self):
+        """ Returns y-distance from the origin to the finish """
+        return self.y_outrance[0]
+
+    def nbytes(self):
+        """ Memory held by the geometry arrays """
+        arrays = [self.x_entrance, self.z_entrance, self.roll,
+                  self.p,
+                  self.y_entrance, self.y_outrance, self.R_in]
+        size = sum(arr.nbytes for arr in arrays)
+
+        # Shared radius profile is stored only once
+        if self.pr.strides[0] == 0:
+            size += self.pr[0].nbytes
+        else:
+            size += self.pr.nbytes
+
+        return size
+
+def reflection_estimates(p, pr, y_entrance, y_outrance,
+                         divergence, samples = 32):
+    """ Capillary.reflection_estimate of many capillaries at once,
+    their coefficients are columns of *p* (6, N) and *pr* (3, N) """
+    t = np.linspace(0., 1., samples)[:, np.newaxis]
+    s = y_entrance + (y_outrance - y_entrance) * t
+    r0 = np.abs(bs.horner(pr, s))
+    x0Bis = bs.derivative_coeffs(bs.derivative_coeffs(p))
+    curvature = np.abs(bs.horner(x0Bis, s))
+
+    with np.errstate(divide='ignore'):
+        bend_step = 4 * np.sqrt(r0 / curvature)
+        straight_step = 2 * r0 / divergence
+    step = np.minimum(bend_step, straight_step)
+
+    # Integral of ds/step over the capillary length
+    ds = s[1] - s[0]
+    return np.sum(ds / step, axis=0)
+
+def capillary_reflections(capillaries, ind, divergence):
+    """ Reflection estimates of capillaries *ind*, straight from
+    the bank arrays when *capillaries* is a CapillaryBank """
+    if isinstance(capillaries, CapillaryBank):
+        return reflection_estimates(capillaries.p[ind].T,
+                                    capillaries.pr[ind].T,
+                                    capillaries.y_entrance[ind],
+                                    capillaries.y_outrance[ind],
+                                    divergence)
+
+    return np.array([capillaries[it].reflection_estimate(divergence)
+                     for it in ind])
+
+def entrance_polar(capillaries):
+    """ Entrance distance from the axis and roll of every
+    capillary, *capillaries* can be a list or a CapillaryBank """
+    if isinstance(capillaries, CapillaryBank):
+        r = np.hypot(capillaries.x_entrance, capillaries.z_entrance)
+        return r, capillaries.roll
+
+    r = [np.hypot(cap.entrance_x(), cap.entrance_z()) for cap in capillaries]
+    roll = [cap.roll for cap in capillaries]
+    return np.array(r), np.array(roll)
+
+def entrance_xz(capillaries):
+    """ Entrance centers in the global frame, *capillaries*
+    can be a list or a CapillaryBank """
+    if isinstance(capillaries, CapillaryBank):
+        return capillaries.x_entrance, capillaries.z_entrance
+
+    x = [cap.entrance_x() for cap in capillaries]
+    z = [cap.entrance_z() for cap in capillaries]
+    return np.array(x), np.array(z)
+
 class PolyCapillaryLens(object):
     """ Multiple capillaries creator class """
     def __init__(self, **kwargs):
@@ -232,10 +542,48 @@ class PolyCapillaryLens(object):
         # And radius changing in the y-direction
         self.radius_y   = bs.radius_curvature
 
+        # Tabulated profiles are off by default
+        self.profile_tolerance = None
+
     def set_structure(self, structure):
         """ Structure setter """
         self.structure = structure
 
+    def set_profile_tolerance(self, tolerance):
+        """ Use interpolated profile tables with the absolute error
+        [mm] below *tolerance*, None means exact polynomials (faster
+        for polynomial bends, see bendshapes.ProfileTable) """
+        self.profile_tolerance = tolerance
+
+    def profile_table(self, radii, p_all):
+        """ Single ProfileTable for the normalized bend shared
+        by all capillaries, None if tables are off or impossible """
+        if self.profile_tolerance is None:
+            return None
+
+        # Some margin for intersection searches near the ends
+        length = self.y['y2'] - self.y['y1']
+        s_min = self.y['y1'] - 0.1 * length
+        s_max = self.y['y2'] + 0.1 * length
+
+        # Bend has to be linear in the entrance radius,
+        # bound the x0 deviation over the whole table
+        radii = np.asarray(radii, dtype=float)
+        p_unit = bs.bend_coefficients(self.bend, [1.], self.y, self.D)[0]
+        powers = max(abs(s_min), abs(s_max)) ** np.arange(6)
+        deviation = np.abs(p_all - np.outer(radii, p_unit)).dot(powers)
+        if deviation.max() > self.profile_tolerance:
+            print 'Bend is not linear in r_in, using exact polynomials'
+            return None
+
+        # Error of x0 grows with the radius, and radius
+        # table is not scaled at all
+        scale = max(1., np.abs(radii).max())
+        tolerance = self.profile_tolerance / scale
+
+        return bs.ProfileTable(p_unit, self.radius_profile(),
+                               s_min, s_max, tolerance)
+
     def set_bend(self, bending_function):
         """ Defines bendiness of each capillary """
         self.bend = bending_function
@@ -244,6 +592,22 @@ class PolyCapillaryLens(object):
         """ Defines capillary width at any point in y-direction """
         self.radius_y = radius_shape_function
 
+    def radius_settings(self):
+        """ Capillary radius settings, same for every capillary """
+        rIn = self.structure.capillary_radius()
+        rOut = rIn * self.D['Dout'] / self.D['Din']
+        rMax = rIn * self.D['Dmax'] / self.D['Din']
+        radius = {'rIn' : rIn, 'rOut' : rOut, 'rMax' : rMax}
+        return radius
+
+    def radius_profile(self):
+        """ Radius polynomial coefficients, computed once per lens
+        and shared (read-only) by all of the capillaries """
+        radius = self.radius_settings()
+        pr = np.array(self.radius_y(self.y, radius), dtype=float)
+        pr.flags.writeable = False
+        return pr
+
     def capillary_parameters(self, r_in, roll):
         """ Prepares arguments for shape defining functions """
         # Default parameters, [xrt.BeamLine, name, position]
@@ -260,10 +624,7 @@ class PolyCapillaryLens(object):
         kwargs.update({'y_outrance' : y_outrance})
 
         # Capillary radius settings
-        rIn = self.structure.capillary_radius()
-        rOut = rIn * self.D['Dout'] / self.D['Din']
-        rMax = rIn * self.D['Dmax'] / self.D['Din']
-        radius = {'rIn' : rIn, 'rOut' : rOut, 'rMax' : rMax}
+        radius = self.radius_settings()
         kwargs.update({'radius' : radius})
 
         # Parameters needed for capillary shape in z direction
@@ -284,19 +645,67 @@ class PolyCapillaryLens(object):
         # Prepare containers
         self.capillaries = []
 
-        # Generate capillaries with positions given
-        # by the lens structure
-        for r, phi in self.structure.polar_coordinates():
+        # Positions given by the lens structure
+        polar = list(self.structure.polar_coordinates())
+        radii = [r for r, phi in polar]
+
+        # Bend coefficients of every capillary from one linear solve
+        p_all = bs.bend_coefficients(self.bend, radii, self.y, self.D)
+
+        # Radius profile is the same for every capillary
+        pr = self.radius_profile()
+
+        # Optional interpolation tables
+        table = self.profile_table(radii, p_all)
+
+        # Generate capillaries
+        for it, (r, phi) in enumerate(polar):
             roll = phi
             r_in = r
 
             # Capillary should care only about r_in and phi variable
             args, kwargs = self.capillary_parameters(r_in, roll)
+            kwargs.update({'p' : p_all[it]})
+            kwargs.update({'pr' : pr})
             capillary = BentCapillary(*args, **kwargs)
+            if table is not None:
+                capillary.set_profile_table(table, r_in)
             self.capillaries.append(capillary)
 
-    def get_capillaries(self):
-        """ get them """
+    def make_bank(self):
+        """ Creates a CapillaryBank without any OE objects """
+        # Positions given by the lens structure
+        r_in, roll = self.structure.polar_arrays()
+
+        # Same convention as in the BentCapillary
+        x_entrance = r_in * np.cos(-roll)
+        z_entrance = r_in * np.sin(-roll)
+
+        # Bend coefficients of every capillary from one linear solve
+        p = bs.bend_coefficients(self.bend, r_in, self.y, self.D)
+
+        # Radius profile is shared by all of the capillaries
+        radius = self.radius_settings()
+        pr = self.radius_profile()
+
+        self.bank = CapillaryBank(self.beamLine,
+                                  x_entrance, z_entrance, roll,
+                                  p, pr,
+                                  y_entrance = self.y['y1'],
+                                  y_outrance = self.y['y2'],
+                                  R_in = radius['rIn'],
+                                  material = self.material)
+
+        # Optional interpolation tables
+        table = self.profile_table(r_in, p)
+        self.bank.set_profile_table(table, r_in)
+
+    def get_capillaries(self, bank = False):
+        """ get them, as a list of OE objects or as a CapillaryBank """
+        if bank:
+            self.make_bank()
+            return self.bank
+
         self.make_capillaries()
         return self.capillaries
 
@@ -331,6 +740,9 @@ class PolyCurveLens(object):
         self.material = mGold
         self.structure = st.HexStructure(rIn = 0.05)
 
+        # Exact polynomials unless tolerance is set
+        self.profile_tolerance = None
+
         # Capillary bend describing function
         self.bend       = bs.capillary_curvature
         # And radius changing in the y-direction
@@ -376,7 +788,11 @@ class PolyCurveLens(object):
         """ This must be a xrt.material object """
         self.material = material
 
-    def get_capillaries(self):
+    def set_profile_tolerance(self, tolerance):
+        """ See PolyCapillaryLens.set_profile_tolerance """
+        self.profile_tolerance = tolerance
+
+    def get_capillaries(self, bank = False):
         """ This returns the final product """
         # Create lens
         lens = PolyCapillaryLens(y_settings=self.y_settings,\
@@ -388,6 +804,7 @@ class PolyCurveLens(object):
         # And y-direction shape for each capillary
         lens.set_bend(self.bend)
         lens.set_radius_shape(self.radius_y)
+        lens.set_profile_tolerance(self.profile_tolerance)
 
-        return lens.get_capillaries()
+        return lens.get_capillaries(bank)
 
@@ -0,0 +1,542 @@
+""" Ray tracing through capillaries with shapes simple enough
+to skip the generic xrt parametric-surface machinery.
+Local frame is the same as the one used by the Capillary:
+local x = cos(roll) x - sin(roll) z, local z = sin(roll) x + cos(roll) z,
+capillary center is [0, 0, 0] and the BeamLine is not tilted.
+trace_cone handles straight capillaries in closed form,
+trace_bank traces rays of many (bent) capillaries at once """
+import numpy as np
+import bendshapes as bs
+from utils import beam as ub
+import xrt.backends.raycing.sources as rs
+
+# Rays must travel at least that much [mm] between
+# two reflections (skips the wall a ray has just left)
+_EPSILON = 1e-9
+
+# Ray states, see xrt.backends.raycing.sources.Beam
+GOOD = 1
+OVER = 3
+
+def copy_beam(beam):
+    """ rs.Beam copy keeping all registered columns (see utils.beam),
+    Beam(copyFrom) knows only the xrt ones """
+    copy = rs.Beam(copyFrom=beam)
+    for column in ub.beam_columns(beam):
+        setattr(copy, column, getattr(beam, column).copy())
+    return copy
+
+class _Rays(object):
+    """ Bare container of ray columns, enough for advance and reflect """
+    pass
+
+class ActiveRays(object):
+    """ Contiguous working copy of the rays still bouncing.
+    Most rays leave after a few reflections, so when the active
+    ones drop below *compaction* of the copy, it is written back
+    to the full beam and gathered anew from the active rays only.
+    Per-ray *arrays* (ray axis last) are gathered along """
+    def __init__(self, beam, active, arrays = {}, compaction = 0.5):
+        """ *active* are indices of rays in the *beam* """
+        self.beam = beam
+        self.arrays = arrays
+        self.compaction = compaction
+        self.columns = ub.beam_columns(beam)
+
+        # Number of active rays in each iteration
+        self.counts = []
+
+        self.work = _Rays()
+        self.start = self.gather(np.asarray(active))
+
+    def gather(self, ind):
+        """ Copy rays *ind* of the full beam, returns their
+        indices in the working copy """
+        self.ids = ind
+        for column in self.columns:
+            setattr(self.work, column, getattr(self.beam, column)[ind])
+        for name, array in self.arrays.items():
+            setattr(self.work, name, array[..., ind])
+        return np.arange(ind.size)
+
+    def scatter(self):
+        """ Write the working copy back to the full beam """
+        for column in self.columns:
+            getattr(self.beam, column)[self.ids] = getattr(self.work, column)
+
+    def update(self, active):
+        """ Rays *active* in this iteration, returns
+        their (possibly new) working copy indices """
+        self.counts.append(active.size)
+        if active.size < self.compaction * self.ids.size:
+            self.scatter()
+            return self.gather(self.ids[active])
+        return active
+
+def rotate_roll(x, z, roll, inverse = False):
+    """ In place rotation of a pair of arrays around the y axis """
+    cos_roll = np.cos(roll)
+    sin_roll = -np.sin(roll) if inverse else np.sin(roll)
+    xn = cos_roll * x - sin_roll * z
+    z[:] = sin_roll * x + cos_roll * z
+    x[:] = xn
+
+def to_local(beam, roll):
+    """ Global -> capillary frame, positions and directions """
+    rotate_roll(beam.x, beam.z, roll)
+    rotate_roll(beam.a, beam.c, roll)
+
+def to_global(beam, roll):
+    """ Capillary -> global frame, positions and directions """
+    rotate_roll(beam.x, beam.z, roll, inverse = True)
+    rotate_roll(beam.a, beam.c, roll, inverse = True)
+
+def advance(beam, ind, t):
+    """ Free flight of rays *ind* by the distance t """
+    beam.x[ind] += beam.a[ind] * t
+    beam.y[ind] += beam.b[ind] * t
+    beam.z[ind] += beam.c[ind] * t
+    beam.path[ind] += t
+
+def reflect(beam, ind, nx, ny, nz, material = None):
+    """ Mirror reflection of rays *ind* on a surface with
+    the normal (nx, ny, nz) pointing into the capillary """
+    a, b, c = beam.a[ind], beam.b[ind], beam.c[ind]
+    beamInDotNormal = a*nx + b*ny + c*nz
+    beam.a[ind] = a - 2 * beamInDotNormal * nx
+    beam.b[ind] = b - 2 * beamInDotNormal * ny
+    beam.c[ind] = c - 2 * beamInDotNormal * nz
+
+    # No material means perfect mirror
+    if material is None:
+        return
+
+    # Intensities are attenuated in the s-p frame of each
+    # reflection, rotation of that frame between reflections
+    # is neglected (at grazing incidence rs ~= rp anyway)
+    refl = material.get_amplitude(beam.E[ind], beamInDotNormal)
+    rs_, rp_ = refl[0], refl[1]
+    beam.Jss[ind] *= (rs_ * np.conj(rs_)).real
+    beam.Jpp[ind] *= (rp_ * np.conj(rp_)).real
+    beam.Jsp[ind] *= rs_ * np.conj(rp_)
+    if hasattr(beam, 'Es'):
+        beam.Es[ind] *= rs_
+        beam.Ep[ind] *= rp_
+
+def smallest_root(A, B, C):
+    """ Smallest t > _EPSILON solving A t**2 + 2B t + C = 0,
+    np.inf where there is none """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disc = B*B - A*C
+        sq = np.sqrt(np.maximum(disc, 0))
+        # Numerically stable pair of roots
+        q = -(B + np.copysign(sq, B))
+        t1 = q / A
+        t2 = C / q
+
+        t1[~(t1 > _EPSILON) | (disc < 0)] = np.inf
+        t2[~(t2 > _EPSILON) | (disc < 0)] = np.inf
+
+    return np.minimum(t1, t2)
+
+def cone_distance(x0, q0, q1, x, y, z, a, b, c):
+    """ Distance along (a, b, c) from (x, y, z) to the wall
+    (x - x0)**2 + z**2 == (q0 + q1*y)**2, q1 == 0 is a cylinder """
+    u = x - x0
+    radius = q0 + q1 * y
+    k = q1 * b
+    A = a*a + c*c - k*k
+    B = u*a + z*c - radius*k
+    C = u*u + z*z - radius*radius
+    t = smallest_root(A, B, C)
+
+    # Only the nappe with positive radius is a wall
+    with np.errstate(invalid='ignore'):
+        t[q0 + q1 * (y + b*t) <= 0] = np.inf
+
+    return t
+
+def cone_normal(x0, q0, q1, x, y, z):
+    """ Wall normal pointing to the capillary axis """
+    u = x - x0
+    radius = q0 + q1 * y
+    ny = radius * q1
+    norm = np.sqrt(u*u + z*z + ny*ny)
+    return -u/norm, ny/norm, -z/norm
+
+def trace_cone(capillary, beam, maxReflections = 1000,
+               compaction = 0.5, counter = None):
+    """ Multiple reflections inside a capillary with straight
+    axis and linear radius, returns (global, local) beams
+    with rays moved to the exit plane of the capillary.
+    Active rays are compacted (see ActiveRays), their number
+    in each iteration is appended to the *counter* list """
+    x0 = capillary.p[0]
+    q0, q1 = capillary.pr[0], capillary.pr[1]
+    y_in = capillary.entrance_y()
+    y_out = capillary.outrance_y()
+    roll = capillary.roll
+
+    lb = copy_beam(beam)
+    lb.nRefl = np.zeros_like(lb.state)
+    to_local(lb, roll)
+
+    # Bring rays to the entrance plane
+    alive = np.flatnonzero(lb.state > 0)
+    forward = lb.b[alive] > 0
+    lb.state[alive[~forward]] = OVER
+    alive = alive[forward]
+    advance(lb, alive, (y_in - lb.y[alive]) / lb.b[alive])
+
+    # Rays outside of the entrance hit the lens front
+    u = lb.x[alive] - x0
+    inside = u*u + lb.z[alive]**2 <= (q0 + q1 * y_in)**2
+    lb.state[alive[~inside]] = OVER
+
+    # Rays are traced in a compacted working copy
+    rays = ActiveRays(lb, alive[inside], compaction = compaction)
+    work = rays.work
+    active = rays.start
+
+    for iRefl in range(maxReflections):
+        active = rays.update(active)
+        if active.size == 0:
+            break
+
+        x, y, z = work.x[active], work.y[active], work.z[active]
+        a, b, c = work.a[active], work.b[active], work.c[active]
+        t = cone_distance(x0, q0, q1, x, y, z, a, b, c)
+        y_hit = y + b*t
+        hit = (y_hit >= y_in) & (y_hit <= y_out)
+
+        # Rays leaving through the exit or back through the entrance
+        leaving = active[~hit]
+        forward = work.b[leaving] > 0
+        exits = leaving[forward]
+        advance(work, exits, (y_out - work.y[exits]) / work.b[exits])
+        work.state[leaving[~forward]] = OVER
+
+        # Reflect the rest
+        active = active[hit]
+        advance(work, active, t[hit])
+        nx, ny, nz = cone_normal(x0, q0, q1, work.x[active],
+                                 work.y[active], work.z[active])
+        reflect(work, active, nx, ny, nz, capillary.material)
+        work.nRefl[active] += 1
+
+    rays.scatter()
+    if counter is not None:
+        counter.extend(rays.counts)
+
+    # Global beam
+    gb = copy_beam(lb)
+    to_global(gb, roll)
+
+    return gb, lb
+
+def axis(p, y, table = None):
+    """ Capillary center x0 and its derivative at *y*: per-ray
+    coefficients p (6, n) or, with a bendshapes.ProfileTable,
+    its tabulated bend scaled by p (1, n) (see Capillary.local_x0) """
+    if table is None:
+        return bs.horner_with_derivative(p, y)
+    scale = p[0]
+    return (scale * table.interpolate(table.x0, y),
+            scale * table.interpolate(table.x0Prime, y))
+
+def radius(pr, y, table = None):
+    """ Capillary radius r0 at *y*, pr (3, n) or the table """
+    if table is None:
+        return bs.horner(pr, y)
+    return table.interpolate(table.r0, y)
+
+def radius_prime(pr, y, table = None):
+    """ Derivative of the radius at *y* """
+    if table is None:
+        return bs.horner_derivative(pr, y)
+    return table.interpolate(table.r0Prime, y)
+
+def wall_function(p, pr, x, y, z, table = None):
+    """ Negative inside of the capillaries with per-ray
+    coefficients p (6, n) and pr (3, n), zero on the wall,
+    same surface as Capillary.local_r (see axis for *table*) """
+    x0, x0Prime = axis(p, y, table)
+    dx = x - x0
+    r = np.hypot(dx, z)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_phi = np.where(r > 0, z / r, 1.)
+    den = cos_phi * x0Prime
+    den *= den
+    den += 1
+    return r - radius(pr, y, table) / den
+
+def wall_normal(p, pr, x, y, z, table = None):
+    """ Capillary.local_n with per-ray coefficients
+    (normal pointing to the capillary axis) """
+    x0, x0Prime = axis(p, y, table)
+    phi = np.arctan2(x - x0, z)
+    sin_phi = np.sin(phi)
+    minus_b = sin_phi * x0Prime + radius_prime(pr, y, table)
+    norm = np.sqrt(1. + minus_b**2)
+    return -sin_phi/norm, minus_b/norm, -np.cos(phi)/norm
+
+def bend_bound(p, y_in, y_out, samples = 33):
+    """ Largest |x0''| along every capillary, p is (N, 6) """
+    p = np.atleast_2d(p)
+    second = [k * (k-1) * p[:, k] for k in range(2, p.shape[1])]
+    bound = np.zeros(p.shape[0])
+    for u in np.linspace(0., 1., samples):
+        s = y_in + u * (y_out - y_in)
+        bound = np.maximum(bound, np.abs(bs.horner(second, s)))
+    return bound
+
+def march_step(p, pr, kappa, x, y, z, a, b, c, fraction, table = None):
+    """ Free path short enough not to step over the wall: a fraction
+    of the radius crossing time and of the chord of the local
+    cylinder, with the bend deviating less than fraction*r0 """
+    x0, x0Prime = axis(p, y, table)
+    r0 = np.abs(radius(pr, y, table))
+
+    # Motion relative to the capillary axis
+    dx = x - x0
+    u = a - x0Prime * b
+    w = c
+    uu = u*u + w*w
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step = fraction * r0 / np.sqrt(uu)
+
+        # Chord of the local cylinder (rays leaving the wall
+        # at a very skew angle cross it quickly)
+        du = dx*u + z*w
+        disc = du*du - uu * (dx*dx + z*z - r0*r0)
+        chord = (-du + np.sqrt(np.maximum(disc, 0))) / uu
+        chord[~(disc > 0)] = np.inf
+        step = np.minimum(step, 0.5 * chord)
+
+        # Axis bends away from its tangent by kappa*dy**2/2
+        dy = np.sqrt(2 * fraction * r0 / kappa)
+        step = np.minimum(step, dy / np.abs(b))
+
+    # Never stall
+    return np.maximum(step, _EPSILON)
+
+def refine_crossing(p, pr, x, y, z, a, b, c, low, high, bisections = 4,
+                    tolerance = 1e-12, max_iterations = 50, table = None):
+    """ Wall crossing inside of the [low, high] bracket: a few
+    bisections (the low end may lie on the wall the ray has
+    just left) followed by the Illinois variant of regula falsi """
+    def wall(t):
+        return wall_function(p, pr, x + a*t, y + b*t, z + c*t, table)
+
+    for _ in range(bisections):
+        mid = 0.5 * (low + high)
+        inside = wall(mid) < 0
+        low = np.where(inside, mid, low)
+        high = np.where(inside, high, mid)
+
+    # Rays stop updating once converged, so every ray gets
+    # the same result whatever else is traced along with it
+    f_low, f_high = wall(low), wall(high)
+    side = np.zeros(low.shape, dtype=int)
+    t = 0.5 * (low + high)
+    f = wall(t)
+    done = np.zeros(low.shape, dtype=bool)
+    for _ in range(max_iterations):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_new = high - f_high * (high - low) / (f_high - f_low)
+        # Degenerate brackets fall back to bisection
+        bad = ~((t_new > low) & (t_new < high))
+        t_new[bad] = 0.5 * (low[bad] + high[bad])
+        f_new = wall(t_new)
+
+        active = ~done
+        t = np.where(active, t_new, t)
+        f = np.where(active, f_new, f)
+        inside = active & (f_new < 0)
+        outside = active & ~(f_new < 0)
+        low = np.where(inside, t_new, low)
+        f_low = np.where(inside, f_new, f_low)
+        high = np.where(outside, t_new, high)
+        f_high = np.where(outside, f_new, f_high)
+
+        # Illinois: halve the value at the end kept twice in a row
+        f_high = np.where(inside & (side == 1), 0.5 * f_high, f_high)
+        f_low = np.where(outside & (side == -1), 0.5 * f_low, f_low)
+        side = np.where(inside, 1, np.where(outside, -1, side))
+
+        done |= (np.abs(f) < tolerance) | (high - low < tolerance)
+        if np.all(done):
+            break
+
+    # Last estimate may be a root with the bracket still wide
+    return np.where(np.abs(f) < tolerance, t, 0.5 * (low + high))
+
+def next_wall_hit(p, pr, kappa, x, y, z, a, b, c, y_in, y_out,
+                  fraction = 0.25, max_steps = 100000, table = None):
+    """ Distance to the wall along (a, b, c) for rays inside the
+    capillaries: marching brackets the first crossing which is
+    then refined. np.inf for rays reaching the y_in or y_out
+    plane first, np.nan for rays that could not be resolved """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_plane = np.where(b > 0, (y_out - y) / b, (y_in - y) / b)
+    t_plane[b == 0] = np.inf
+
+    lo = np.zeros_like(x)
+    hi = np.full_like(x, np.inf)
+    searching = np.arange(x.size)
+    for _ in range(max_steps):
+        if searching.size == 0:
+            break
+
+        ids = searching
+        P, PR = p[:, ids], pr[:, ids]
+        t0 = lo[ids]
+        xs, ys, zs = x[ids] + a[ids]*t0, y[ids] + b[ids]*t0, z[ids] + c[ids]*t0
+        step = march_step(P, PR, kappa[ids], xs, ys, zs,
+                          a[ids], b[ids], c[ids], fraction, table)
+        t1 = np.minimum(t0 + step, t_plane[ids])
+
+        f = wall_function(P, PR, x[ids] + a[ids]*t1, y[ids] + b[ids]*t1,
+                          z[ids] + c[ids]*t1, table)
+        crossed = f >= 0
+        hi[ids[crossed]] = t1[crossed]
+        lo[ids[~crossed]] = t1[~crossed]
+
+        at_plane = t1 >= t_plane[ids]
+        searching = ids[~crossed & ~at_plane]
+
+    # Stuck rays
+    lo[searching] = np.nan
+
+    # Refine the bracketed crossings
+    ids = np.flatnonzero(np.isfinite(hi))
+    t = np.full_like(x, np.inf)
+    t[ids] = refine_crossing(p[:, ids], pr[:, ids], x[ids], y[ids], z[ids],
+                             a[ids], b[ids], c[ids], lo[ids], hi[ids],
+                             table = table)
+    t[np.isnan(lo)] = np.nan
+    return t
+
+def trace_bank(bank, beam, channel, maxReflections = 1000,
+               fraction = 0.25, compaction = 0.5, counter = None):
+    """ Multiple reflections of rays in all capillaries of a
+    CapillaryBank at once, *channel* is the capillary index of
+    every ray (-1 for rays not entering the lens). Every ray
+    gets its capillary coefficients gathered from the bank and
+    is traced in its own capillary frame. Returns (global,
+    local) beams with rays moved to the exit plane.
+    Active rays are compacted together with their geometry
+    (see ActiveRays), their number in each iteration is
+    appended to the *counter* list. Walls come from the bank
+    profile table when it has one (see axis) """
+    channel = np.asarray(channel)
+    table = bank.table
+
+    lb = copy_beam(beam)
+    lb.nRefl = np.zeros_like(lb.state)
+
+    # Rays without a capillary are lost
+    valid = (channel >= 0) & (lb.state > 0)
+    lb.state[~valid] = OVER
+    ch = np.where(valid, channel, 0)
+
+    # Per-ray capillary frame and geometry
+    roll = bank.roll[ch]
+    to_local(lb, roll)
+    if table is None:
+        p = bank.p[ch].T
+    else:
+        p = bank.table_scale[ch][np.newaxis]
+    pr = bank.pr[ch].T
+    y_in = bank.y_entrance[ch]
+    y_out = bank.y_outrance[ch]
+
+    # Bend bound of every capillary in use
+    used, inverse = np.unique(ch, return_inverse=True)
+    kappa = bend_bound(bank.p[used], bank.y_entrance[used],
+                       bank.y_outrance[used])[inverse]
+
+    # Bring rays to the entrance plane
+    alive = np.flatnonzero(valid)
+    forward = lb.b[alive] > 0
+    lb.state[alive[~forward]] = OVER
+    alive = alive[forward]
+    advance(lb, alive, (y_in[alive] - lb.y[alive]) / lb.b[alive])
+
+    # Rays outside of their entrance hit the lens front
+    inside = wall_function(p[:, alive], pr[:, alive], lb.x[alive],
+                           lb.y[alive], lb.z[alive], table) < 0
+    lb.state[alive[~inside]] = OVER
+
+    # Rays are traced in a compacted working copy
+    arrays = {'p' : p, 'pr' : pr, 'kappa' : kappa,
+              'y_in' : y_in, 'y_out' : y_out}
+    rays = ActiveRays(lb, alive[inside], arrays, compaction)
+    work = rays.work
+    active = rays.start
+
+    for iRefl in range(maxReflections):
+        active = rays.update(active)
+        if active.size == 0:
+            break
+
+        P, PR = work.p[:, active], work.pr[:, active]
+        t = next_wall_hit(P, PR, work.kappa[active],
+                          work.x[active], work.y[active], work.z[active],
+                          work.a[active], work.b[active], work.c[active],
+                          work.y_in[active], work.y_out[active], fraction,
+                          table = table)
+
+        # Unresolved rays are dropped
+        lost = np.isnan(t)
+        work.state[active[lost]] = OVER
+
+        # Rays leaving through the exit or back through the entrance
+        leaving = np.isinf(t)
+        forward = work.b[active] > 0
+        exits = active[leaving & forward]
+        advance(work, exits,
+                (work.y_out[exits] - work.y[exits]) / work.b[exits])
+        work.state[active[leaving & ~forward]] = OVER
+
+        # Reflect the rest
+        hit = ~leaving & ~lost
+        active, t = active[hit], t[hit]
+        advance(work, active, t)
+        nx, ny, nz = wall_normal(work.p[:, active], work.pr[:, active],
+                                 work.x[active], work.y[active],
+                                 work.z[active], table)
+        reflect(work, active, nx, ny, nz, bank.material)
+        work.nRefl[active] += 1
+
+    rays.scatter()
+    if counter is not None:
+        counter.extend(rays.counts)
+
+    # Global beam
+    gb = copy_beam(lb)
+    to_global(gb, roll)
+
+    return gb, lb
+
+class _SingleBank(object):
+    """ Bank arrays of one capillary, enough for trace_bank """
+    def __init__(self, capillary):
+        """ Coefficients and profile table of the capillary """
+        self.roll = np.array([capillary.roll], dtype=float)
+        self.p = np.asarray(capillary.p, dtype=float).reshape(1, -1)
+        self.pr = np.asarray(capillary.pr, dtype=float).reshape(1, -1)
+        self.y_entrance = np.array([capillary.entrance_y()], dtype=float)
+        self.y_outrance = np.array([capillary.outrance_y()], dtype=float)
+        self.material = capillary.material
+        self.table = capillary.table if capillary.use_table else None
+        self.table_scale = np.array([capillary.table_scale], dtype=float)
+
+def trace_capillary(capillary, beam, maxReflections = 1000,
+                    compaction = 0.5, counter = None):
+    """ trace_bank for all rays in one Capillary """
+    channel = np.zeros(beam.state.size, dtype=int)
+    return trace_bank(_SingleBank(capillary), beam, channel,
+                      maxReflections, compaction = compaction,
+                      counter = counter)
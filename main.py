@@ -17,7 +17,6 @@ from elements import structures as es
 from setups import firstlens as fl
 
 import xrt.backends.raycing.materials as rm
-import xrt.backends.raycing.run as rr
 
 def create_beam(dirname):
     """ Generates csv files filled with photons inside the dirname directory """
@@ -41,7 +40,8 @@ def create_beam(dirname):
     # ... and radius 
     # lens.set_capillary_radius_function(radius_function)
 
-    caps = lens.get_capillaries()
+    # Capillary bank geometry is shared by the worker processes
+    caps = lens.get_capillaries(bank = True)
 
     setup = fl.MultipleCapillariesFittedSource()
     # setup = fl.MultipleCapillariesNormalSource()
@@ -54,6 +54,10 @@ def create_beam(dirname):
     setup.set_dzprime(0.02)
     setup.set_dxprime(0.02)
 
+    # Most of such divergent rays would be absorbed at once, sample
+    # mostly those within the capillary acceptance (weighted rays)
+    setup.set_importance(0.9)
+
     if False:
         # Set source width and height
         setup.set_dx(1)
@@ -73,11 +77,6 @@ def create_beam(dirname):
 
     return True
 
-# FIXME
-# This is not pretty, yet obligatory (only for beam creation)
-rr.run_process = fl.MultipleCapillariesFittedSource.local_process
-# rr.run_process = fl.MultipleCapillariesNormalSource.local_process
-
 if __name__ == '__main__':
     """ console$: python main.py """
     # Creating example beam from default lens-A object
@@ -1,18 +1,19 @@
 import os
 import itertools
 import numpy as np
-import multiprocessing as mp
-from datetime import datetime as dt
 
-import xrt.runner as xrtr
 import xrt.plotter as xrtp
-import xrt.backends.raycing.run as rr
 import xrt.backends.raycing as raycing
 import xrt.backends.raycing.sources as rs
 import xrt.backends.raycing.screens as rsc
 
 from utils import beam as ub
+from utils import streams as us
 from elements import sources as es
+from elements import structures as st
+from lenses import polycapillary as pl
+from lenses import tracing as tr
+from setups import scheduler as sc
 
 class MultipleCapillaries(object):
     """ Abstract class for xrt setups with multiple capillaries """
@@ -22,7 +23,7 @@ class MultipleCapillaries(object):
         self.beamLine = raycing.BeamLine()
 
         # Self-referencing via the beamline allows
-        # the usage of class specific methods within the run_process
+        # the usage of class specific methods with the beamline only
         self.beamLine.self = self
 
         # TODO Make this auto-adjustable
@@ -31,10 +32,7 @@ class MultipleCapillaries(object):
         # Set of OE objects capable of multiple_reflections
         self.capillaries = []
 
-        # Machine dependent
-        # FIXME setting 1 is currently a no-go due to 
-        # mp.Process not having a iterable id
-        # and _identity[0] throws an error
+        # Machine dependent, 1 runs without a process pool
         self.processes = 2
 
         # Container for xrt::plots
@@ -64,10 +62,38 @@ class MultipleCapillaries(object):
         # Number of iterations
         self.repeats = 4
 
+        # Root of the random streams of all capillaries and
+        # repeats (see utils.streams), None is not reproducible
+        self.seed = None
+
+        # Spatial index of capillary entrances
+        # (see MultipleCapillariesNormalSource)
+        self.index = None
+
+        # Trace one capillary per radius shell and
+        # rotate its rays to the other shell members
+        self.symmetric = False
+
+        # Storage of traced photons: 'binary' or 'csv'
+        # (see utils.beam.BeamWriter)
+        self.beam_format = 'binary'
+
+        # Memory-mapped lens geometry (see share_geometry)
+        self.geometry_folder = None
+
+        # Trace all capillaries of a work unit in one array
+        # pass (see lenses.tracing.trace_bank)
+        self.batched = False
+
+        # Share of rays sampled within the capillary acceptance,
+        # None for plain sampling (see MultipleCapillariesFittedSource)
+        self.importance = None
+
     def set_capillaries(self, caps):
         """ do it """
         self.capillaries = caps
         self.beamLine.capillaries = caps
+        self.geometry_folder = None
 
         print 'Setup now contains {} capillaries'.format(len(caps))
 
@@ -88,6 +114,27 @@ class MultipleCapillaries(object):
         """ adjust with the number of cores available """
         self.repeats = peats
 
+    def set_seed(self, seed):
+        """ Same seed gives the same photons, on any number of processes """
+        self.seed = seed
+
+    def set_symmetric(self, symmetric):
+        """ Exploit rotational symmetry of the lens """
+        self.symmetric = symmetric
+
+    def set_batched(self, batched):
+        """ Only for capillaries in a CapillaryBank """
+        self.batched = batched
+
+    def set_importance(self, fraction):
+        """ Concentrate *fraction* of rays on directions the
+        capillaries can transmit, rays get statistical weights """
+        self.importance = fraction
+
+    def set_beam_format(self, beam_format):
+        """ Binary storage is much faster, csv is human readable """
+        self.beam_format = beam_format
+
     def set_processes(self, howmany):
         """ Consult with Your number of cores """
         self.processes = howmany
@@ -117,31 +164,106 @@ class MultipleCapillaries(object):
         """ This should be setup-specific """
         pass
 
-    def local_filepath(self, process_id):
+    def local_filepath(self, name):
         """ Generate unique files for keeping photons
-            generated in separate processes """
-        filepath = self.savefolder + '/process{}.csv'.format(process_id)
+            generated in separate work units """
+        if self.beam_format == 'csv':
+            suffix = '.csv'
+        else:
+            suffix = ub.BINARY_SUFFIX
+        filepath = self.savefolder + '/' + name + suffix
         return filepath
 
-    @staticmethod
-    def local_process(beamLine, shineOnly1stSource=False):
-        """ Override this method in Your setup """
+    def beam_writer(self, filepath):
+        """ Buffered storage for photons of one work unit """
+        if self.beam_format == 'csv':
+            return ub.CsvWriter(filepath)
+        return ub.BeamWriter(filepath)
+
+    def share_geometry(self):
+        """ Geometry of a CapillaryBank goes to memory-mapped files
+        inside the savefolder, so the main process and all of the
+        workers read the same pages instead of holding copies """
+        if not isinstance(self.capillaries, pl.CapillaryBank):
+            return
+
+        # Once per set of capillaries
+        if self.geometry_folder is None:
+            folder = os.path.join(self.savefolder, 'geometry')
+            self.capillaries.share(folder)
+            self.geometry_folder = folder
+
+        self.attach_geometry()
+
+    def attach_geometry(self):
+        """ Map the shared geometry (workers call it at start) """
+        if self.geometry_folder is None:
+            return
+
+        bank = pl.CapillaryBank.attach(self.capillaries.beamLine,
+                                       self.geometry_folder,
+                                       self.capillaries.material)
+        self.capillaries = bank
+        self.beamLine.capillaries = bank
+
+    def use_stream(self, repeat, key):
+        """ Photons of the item *key* in *repeat* come
+        from their own random stream """
+        stream = us.make_stream(self.seed, repeat, key)
+        if hasattr(self.source, 'set_random_state'):
+            self.source.set_random_state(stream)
+            # Global np.random (xrt) gets a stream of its own, the
+            # source one is used as in trace_shells, without advancing
+            stream = us.make_stream(self.seed, repeat, key, 'xrt')
+        us.use_stream(stream)
+
+    def work_items(self):
+        """ Independent pieces of one repeat (setup-specific) """
+        return []
+
+    def process_items(self, items, writer, repeat = 0):
+        """ Trace *items* of the *repeat* and pass
+        the photons to the writer """
         pass
 
-    def run_it(self):
-        """ do it """
+    def item_costs(self, items):
+        """ Estimated relative cost of tracing each of the items """
+        return np.ones(len(items))
+
+    def run_it(self, resume = False):
+        """ do it, with *resume* work units committed by the last
+        (killed) run are skipped instead of starting a new run """
         self.make_source()
-        # self.make_run_process()
         self.beamTotal = None
 
-        # FIXME this actually is obsolete
-        # and process managing should be done in some
-        # simpler way than xrt is handling it atm
-        # 
-        xrtr.run_ray_tracing(self.plots,
-                            repeats=self.repeats,\
-                            beamLine=self.beamLine,\
-                            processes=self.processes)
+        if not os.path.exists(self.savefolder):
+            os.makedirs(self.savefolder)
+
+        # Workers map lens geometry instead of copying it
+        self.share_geometry()
+
+        # Every unit writes its own chunk of photons
+        # and gets recorded in the manifest when done
+        manifest = sc.Manifest(self.savefolder)
+
+        # Output of killed units must not be read as photons
+        manifest.cleanup()
+        if resume:
+            # Last session started, even if nothing got committed
+            session = max(manifest.last_session(), 0)
+            done = manifest.completed(session)
+            print 'Resuming: {} items already done'.format(len(done))
+        else:
+            session = manifest.last_session() + 1
+            done = set()
+        if session > manifest.last_session():
+            manifest.begin(session)
+
+        # Repeats are split into work units traced by a process pool
+        scheduler = sc.Scheduler(self, self.processes)
+        units = scheduler.make_units(self.repeats, session, done)
+        report = scheduler.run(units, manifest, session)
+        sc.print_report(report)
 
     def get_source(self):
         """ it's free """
@@ -183,51 +305,138 @@ class MultipleCapillariesFittedSource(MultipleCapillaries):
             distE=distE, energies=energies,
             polarization=self.polarization)
 
-    @staticmethod
-    def local_process(beamLine, shineOnly1stSource=False):
-        """ raycing.run_process must be overriden globally """
-	# Debug info
-        process_id = mp.current_process()._identity[0]
-	debug_start = 'Prcoess {} started at: {}.'
-        print debug_start.format(process_id , dt.now())
-
-        # For every capillary
-        for it, cap in enumerate(beamLine.capillaries):
-            hitpoint = [cap.entrance_x(),
-                        cap.entrance_y(),
-                        cap.entrance_z()]
-
-            # shine directly into its center
-            light = beamLine.sources[0].shine(hitpoint)
-
-            # and perform reflections
-            beamLocal, _ = cap.multiple_reflect(light,\
-                                    maxReflections=550)
+        if self.importance is not None:
+            angle = self.acceptance_angle()
+            if angle is None:
+                print 'No wall material, importance sampling is off'
+            else:
+                self.source.set_acceptance(angle, self.importance)
+
+    def lowest_energy(self):
+        """ Lower end of the source energy distribution """
+        if self.distE == 'normal':
+            return self.energies[0] - 3 * self.energies[1]
+        return min(self.energies)
+
+    def acceptance_angle(self):
+        """ Directions transmitted by the capillaries: critical angle
+        of the wall at the lowest energy, plus the angle of rays
+        crossing the whole entrance without reflections """
+        capillary = self.capillaries[0]
+        if capillary.material is None:
+            return None
+
+        # n = 1 - delta, critical angle = sqrt(2 delta)
+        energy = max(self.lowest_energy(), 1.)
+        n = capillary.material.get_refractive_index(energy)
+        critical = np.sqrt(2 * (1 - np.real(n)))
+
+        length = capillary.outrance_y() - capillary.entrance_y()
+        straight = 2 * capillary.entrance_radius() / length
+
+        return critical + straight
 
-            # We wan't to keep only alive photons
-            # TODO but we need to know how many were generated!
-            beamLocal.filter_good()
-
-            # After each capillary write to csv file
-            frame = ub.make_dataframe(beamLocal)
-            filepath = beamLine.self.local_filepath(process_id)
-
-            # Add header only when creating the file
-            header_needed = not os.path.isfile(filepath)
-            frame.to_csv(filepath, mode='a', header=header_needed)
-
-            # Every 100 capillaries inform user about progress
-            if it%100 is 0:
-		debug_inside = 'Capillary {} done at process {} in time {}'
-		print debug_inside.format(it, process_id, dt.now())
-
-	# Inform user that this run is over
-	debug_finish = 'Prcoess {} finished at: {}.'
-        print debug_finish.format(process_id, dt.now())
-
-        # Return empty dict for xrt compability
-        out = {}
-        return out
+    @staticmethod
+    def trace_capillary(beamLine, cap):
+        """ Shine into the capillary entrance and reflect """
+        hitpoint = [cap.entrance_x(),
+                    cap.entrance_y(),
+                    cap.entrance_z()]
+
+        # shine directly into its center
+        light = beamLine.sources[0].shine(hitpoint)
+
+        # and perform reflections
+        beamLocal, _ = cap.multiple_reflect(light,\
+                                maxReflections=550)
+
+        # xrt's own loop (cap.compacted == False) copies only
+        # its columns, ray order is kept so weights can be restored
+        if hasattr(light, 'weight') and not hasattr(beamLocal, 'weight'):
+            beamLocal.weight = light.weight.copy()
+
+        # We wan't to keep only alive photons
+        # TODO but we need to know how many were generated!
+        good = (beamLocal.state == 1) | (beamLocal.state == 2)
+        return ub.copy_by_index(beamLocal, good)
+
+    def work_items(self):
+        """ Capillaries at the same distance from the axis are
+        identical up to the roll, so in the symmetric mode
+        only the first one of each shell is traced """
+        if self.symmetric:
+            radii, self.rolls = pl.entrance_polar(self.capillaries)
+            return st.radius_shells(radii)
+
+        return [[it] for it in range(len(self.capillaries))]
+
+    def item_costs(self, shells):
+        """ One traced capillary per shell, with cost growing with
+        the number of reflections, plus writing all shell members """
+        divergence = max(self.x_divergence, self.z_divergence)
+        representatives = [shell[0] for shell in shells]
+        reflections = pl.capillary_reflections(self.capillaries,
+                                               representatives, divergence)
+        sizes = np.array([len(shell) for shell in shells])
+        return 1 + reflections + sizes
+
+    def trace_shells(self, shells, repeat = 0):
+        """ Shine into the representative of every shell and trace
+        them all at once, returns the good rays of each shell """
+        bank = self.capillaries
+        representatives = np.array([shell[0] for shell in shells])
+
+        # With a seed every shell has its own stream, as in trace_shell,
+        # so rays do not depend on how shells are grouped into units
+        streams = None
+        if self.seed is not None:
+            streams = [us.make_stream(self.seed, repeat, it)
+                       for it in representatives]
+
+        # Rays for all entrances, tagged with their capillary
+        hitpoints = np.column_stack([bank.x_entrance[representatives],
+                                     bank.y_entrance[representatives],
+                                     bank.z_entrance[representatives]])
+        light = self.source.shine_many(hitpoints, self.nrays,
+                                       channels = representatives,
+                                       streams = streams)
+        beamAll, _ = tr.trace_bank(bank, light, light.channel,
+                                   maxReflections = 550)
+
+        # Rays of each shell are contiguous
+        good = (beamAll.state == 1) | (beamAll.state == 2)
+        offsets = self.nrays * np.arange(len(shells) + 1)
+        beamsShell = []
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            ind = start + np.flatnonzero(good[start : stop])
+            beamsShell.append(ub.copy_by_index(beamAll, ind))
+
+        return beamsShell
+
+    def trace_shell(self, shell, repeat = 0):
+        """ Trace the representative of a shell with its own stream """
+        self.use_stream(repeat, shell[0])
+        representative = self.capillaries[shell[0]]
+        return self.trace_capillary(self.beamLine, representative)
+
+    def process_items(self, shells, writer, repeat = 0):
+        """ Trace shells of capillaries (see work_items) """
+        if self.batched and isinstance(self.capillaries, pl.CapillaryBank):
+            beamsShell = self.trace_shells(shells, repeat)
+        else:
+            beamsShell = (self.trace_shell(shell, repeat)
+                          for shell in shells)
+
+        for shell, beamShell in itertools.izip(shells, beamsShell):
+            for member in shell:
+                if member == shell[0]:
+                    beamLocal = beamShell
+                else:
+                    angle = self.rolls[shell[0]] - self.rolls[member]
+                    beamLocal = ub.rotate_beam(beamShell, angle)
+
+                # Rays are written in big chunks by the writer
+                writer.write(beamLocal)
 
 class MultipleCapillariesNormalSource(MultipleCapillaries):
     """ One source shining into all of the capillaries """
@@ -261,59 +470,73 @@ class MultipleCapillariesNormalSource(MultipleCapillaries):
             distE=distE, energies=energies,
             polarization=self.polarization)
 
-    @staticmethod
-    def local_process(beamLine, shineOnly1stSource=False):
-        """ raycing.run_process must be overriden globally """
-	# Debug info
-        process_id = mp.current_process()._identity[0]
-	debug_start = 'Prcoess {} started at: {}.'
-        print debug_start.format(process_id , dt.now())
-
-        # Shine once per run
-        light = beamLine.sources[0].shine()
-
-        # For every capillary
-        for it, cap in enumerate(beamLine.capillaries):
-            hitpoint = [cap.entrance_x(),
-                        cap.entrance_y(),
-                        cap.entrance_z()]
-
-            # Perform reflections
-            beamLocal, _ = cap.multiple_reflect(light,\
+    def entrance_index(self):
+        """ Spatial index of capillary entrances, built once """
+        if self.index is None:
+            x, z = pl.entrance_xz(self.capillaries)
+            radius = self.capillaries[0].entrance_radius()
+            self.index = st.EntranceIndex(x, z, radius)
+        return self.index
+
+    def work_items(self):
+        """ Source shines into the whole lens at once """
+        return [range(len(self.capillaries))]
+
+    def process_items(self, items, writer, repeat = 0):
+        """ Trace items one by one (see trace_item) """
+        for item in items:
+            self.trace_item(item, writer, repeat)
+
+    def trace_item(self, item, writer, repeat = 0):
+        """ Shine once and trace capillaries of the item """
+        capillaries = self.capillaries
+        wanted = np.zeros(len(capillaries), dtype=bool)
+        wanted[item] = True
+
+        # Shine once per item, from its own stream
+        self.use_stream(repeat, sc.item_key(item))
+        light = self.beamLine.sources[0].shine()
+
+        # Every ray can enter only one channel: find it at the
+        # lens entrance plane, rays hitting the walls are dropped
+        y_entrance = capillaries[0].entrance_y()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            path = (y_entrance - light.y) / light.b
+        x = light.x + light.a * path
+        z = light.z + light.c * path
+        channel = self.entrance_index().assign(x, z)
+        channel[~(path >= 0) | (light.state <= 0)] = -1
+
+        # Only capillaries with rays are traced
+        groups = st.EntranceIndex.groups(channel)
+        for which, ids in groups:
+            if not wanted[which]:
+                continue
+            cap = capillaries[which]
+
+            # Perform reflections of own rays only
+            beam = ub.copy_by_index(light, ids)
+            beamLocal, _ = cap.multiple_reflect(beam,\
                                     maxReflections=550)
 
             # We wan't to keep only alive photons
             # TODO but we need to know how many were generated!
             beamLocal.filter_good()
 
-            # After each capillary write to csv file
-            frame = ub.make_dataframe(beamLocal)
-            filepath = beamLine.self.local_filepath(process_id)
-
-            # Add header only when creating the file
-            header_needed = not os.path.isfile(filepath)
-            frame.to_csv(filepath, mode='a', header=header_needed)
-
-            # Every 100 capillaries inform user about progress
-	    if it%100 is 0:
-		debug_inside = 'Capillary {} done at process {} in time {}'
-		print debug_inside.format(it, process_id, dt.now())
-
-	# Inform user that this run is over
-	debug_finish = 'Prcoess {} finished at: {}.'
-        print debug_finish.format(process_id, dt.now())
-
-        # Return empty dict for xrt compability
-        out = {}
-        return out
+            # Rays are written in big chunks by the writer
+            writer.write(beamLocal)
 
     def set_capillaries(self, caps):
         """ do it """
         self.capillaries = caps
         self.beamLine.capillaries = caps
+        self.geometry_folder = None
 
         print 'Setup no contains {} capillaries'.format(len(caps))
 
+        # Rebuilt for the new capillaries when needed
+        self.index = None
+
         # Used for source fitting
         radius = caps[0].entrance_radius()
         self.x_size = self.z_size = radius/2.0
@@ -321,3 +544,39 @@ class MultipleCapillariesNormalSource(MultipleCapillaries):
         # Position the source at the lens entrance
         # (-0.01 is for numerical safety FIXME)
         self.source_position = [0, 0, 0]
+
+def test_importance_weights(nrays = 100):
+    """ Stored photons of an importance sampled run carry their
+    weights, for both the per-capillary and the batched path """
+    import shutil
+    import tempfile
+
+    # Same lens as in main.create_beam, only smaller
+    lens = pl.PolyCurveLens('A')
+    lens.set_structure(st.HexStructure(rIn = 0.005,
+                                       nx_capillary = 3,
+                                       ny_bundle = 1))
+    caps = lens.get_capillaries(bank = True)
+
+    for batched in [False, True]:
+        folder = tempfile.mkdtemp()
+        try:
+            setup = MultipleCapillariesFittedSource()
+            setup.set_capillaries(caps)
+            setup.set_dxprime(0.02)
+            setup.set_dzprime(0.02)
+            setup.set_importance(0.9)
+            setup.set_batched(batched)
+            setup.set_nrays(nrays)
+            setup.set_processes(1)
+            setup.set_repeats(1)
+            setup.set_folder(folder)
+            setup.run_it()
+
+            beam = ub.load_beam(folder)
+            assert hasattr(beam, 'weight')
+            assert beam.weight.size == beam.x.size
+            assert np.all(beam.weight > 0)
+            print 'batched:', batched, 'mean weight:', beam.weight.mean()
+        finally:
+            shutil.rmtree(folder)
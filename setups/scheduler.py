@@ -0,0 +1,267 @@
+""" Process pool running setups (see setups.firstlens) in
+work units: pieces of one repeat, traced and written to disk
+independently, without overriding xrt's run_process """
+import os
+import time
+import json
+import heapq
+import shutil
+import itertools
+from glob import glob
+import numpy as np
+import multiprocessing as mp
+from datetime import datetime as dt
+
+# Setup being run, forked workers inherit it
+# so only the small work units are pickled
+_setup = None
+
+def worker_id():
+    """ 1..N inside of pool workers, 0 in the main process """
+    identity = mp.current_process()._identity
+    if identity:
+        return identity[0]
+    return 0
+
+def init_worker():
+    """ Forked workers start with the same global random state,
+    make it independent (setups draw photons from their own
+    streams anyway, see utils.streams), and map the shared
+    lens geometry if there is one """
+    np.random.seed()
+
+    if hasattr(_setup, 'attach_geometry'):
+        _setup.attach_geometry()
+
+def item_key(item):
+    """ Items are lists of capillary ids, the first one names it """
+    return int(item[0])
+
+def run_unit(unit):
+    """ Trace all items of one (repeat, items, cost, name) unit
+    into its own output chunk, returns (worker id, estimated cost,
+    busy time [s], repeat, item keys, name) """
+    start = time.time()
+    repeat, items, cost, name = unit
+
+    # Output is written aside and becomes visible at once
+    # (rename is atomic), so killed units leave only .part files
+    filepath = _setup.local_filepath(name)
+    temporary = filepath + '.part'
+    writer = _setup.beam_writer(temporary)
+    _setup.process_items(items, writer, repeat)
+    writer.close()
+    if os.path.exists(temporary):
+        os.rename(temporary, filepath)
+
+    keys = [item_key(item) for item in items]
+    return worker_id(), cost, time.time() - start, repeat, keys, name
+
+class Manifest(object):
+    """ Record of sessions started and work units with committed
+    output, one json line each, kept in the output folder of the setup """
+    def __init__(self, folder):
+        """ Reads whatever was committed before """
+        self.folder = folder
+        self.filepath = os.path.join(folder, 'manifest.jsonl')
+        self.records = []
+        if os.path.isfile(self.filepath):
+            with open(self.filepath) as f:
+                for line in f:
+                    # Last line may be cut by a kill
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        pass
+
+    def last_session(self):
+        """ Runs started without resume get new session numbers,
+        the last one started may have been killed before any
+        of its units was committed """
+        sessions = [record['session'] for record in self.records]
+        return max(sessions) if sessions else -1
+
+    def units(self):
+        """ Records of committed units, without session starts """
+        return [record for record in self.records if 'chunk' in record]
+
+    def completed(self, session):
+        """ Set of (repeat, item key) done in the session """
+        done = set()
+        for record in self.units():
+            if record['session'] == session:
+                for key in record['items']:
+                    done.add((record['repeat'], key))
+        return done
+
+    def append(self, record):
+        """ Make the *record* durable """
+        with open(self.filepath, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records.append(record)
+
+    def begin(self, session):
+        """ New session is recorded before its first unit runs """
+        self.append({'session' : session, 'started' : str(dt.now())})
+
+    def commit(self, session, repeat, keys, name):
+        """ Unit output is in place, make it durable """
+        self.append({'session' : session, 'repeat' : repeat,
+                     'items' : keys, 'chunk' : name})
+
+    def cleanup(self, session = '*'):
+        """ Remove unfinished output and chunks of the session
+        (all sessions by default) written but not committed
+        before the run was killed """
+        committed = set(record['chunk'] for record in self.units())
+        paths = glob(os.path.join(self.folder, '*.part'))
+        for path in glob(os.path.join(self.folder, chunk_name(session, '*'))):
+            name = os.path.basename(path).split('.')[0]
+            if name not in committed:
+                paths.append(path)
+
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+def chunk_name(session, repeat, key = '*'):
+    """ Output of one unit, unique within the session """
+    return 's{}_r{}_c{}'.format(session, repeat, key)
+
+def balance(items, costs, howmany):
+    """ Longest processing time first: the most expensive
+    remaining item goes to the cheapest of *howmany* bins,
+    returns a list of (items, total cost) """
+    bins = [(0., it, []) for it in range(howmany)]
+    for it in np.argsort(costs)[::-1]:
+        total, which, content = heapq.heappop(bins)
+        content.append(items[it])
+        heapq.heappush(bins, (total + costs[it], which, content))
+
+    return [(content, total) for total, _, content in bins if content]
+
+def print_report(report):
+    """ Per-worker summary of Scheduler.run """
+    busy = [report[worker]['busy'] for worker in report]
+    total = max(sum(busy), 1e-12)
+
+    print '{:>8} {:>8} {:>12} {:>12} {:>8}'.format('worker', 'units',
+                                                   'cost', 'busy [s]',
+                                                   'share')
+    for worker in sorted(report):
+        stats = report[worker]
+        print '{:>8} {:>8} {:>12.1f} {:>12.2f} {:>8.3f}'.format(
+            worker, stats['units'], stats['cost'],
+            stats['busy'], stats['busy'] / total)
+
+    # 1.0 means all workers finished together
+    if busy:
+        balance_ratio = np.mean(busy) / max(max(busy), 1e-12)
+        print 'Balance (mean/max busy time): {:.3f}'.format(balance_ratio)
+
+class Scheduler(object):
+    """ Splits repeats of a setup into work units
+    and runs them on a pool of *processes* """
+    def __init__(self, setup, processes = 1):
+        """ Any setup with work_items, item_costs,
+        process_items and beam_writer """
+        self.setup = setup
+        self.processes = processes
+
+        # Items per unit, None for a few units per process
+        self.unit_size = None
+
+    def set_unit_size(self, size):
+        """ Small units balance better, big ones have less overhead """
+        self.unit_size = size
+
+    def make_units(self, repeats, session = 0, done = set()):
+        """ List of (repeat, items, cost, name) tuples, items of each
+        repeat are split into units of similar estimated cost,
+        most expensive units go first. Items with (repeat, key)
+        in *done* are skipped """
+        items = self.setup.work_items()
+        costs = np.asarray(self.setup.item_costs(items), dtype=float)
+        keys = [item_key(item) for item in items]
+
+        units = []
+        for repeat in range(repeats):
+            todo = [it for it, key in enumerate(keys)
+                    if (repeat, key) not in done]
+            if not todo:
+                continue
+
+            if self.unit_size is None:
+                howmany = 4 * self.processes
+            else:
+                howmany = int(np.ceil(len(todo) / float(self.unit_size)))
+            howmany = max(1, min(howmany, len(todo)))
+
+            bins = balance([items[it] for it in todo], costs[todo], howmany)
+            for content, cost in bins:
+                name = chunk_name(session, repeat, item_key(content[0]))
+                units.append((repeat, content, cost, name))
+
+        # Pool takes units in order, so this is LPT
+        # scheduling onto the workers that are free first
+        units.sort(key = lambda unit: -unit[2])
+
+        return units
+
+    def run(self, units, manifest = None, session = 0):
+        """ Trace all units, returns a dict with units,
+        estimated cost and busy time of each worker.
+        Finished units are committed to the *manifest* """
+        global _setup
+        _setup = self.setup
+        self.manifest = manifest
+        self.session = session
+
+        print 'Running {} units on {} processes'.format(len(units),
+                                                      self.processes)
+        try:
+            # No pool at all for a single process
+            if self.processes == 1:
+                # Lazy, so every unit is committed as soon as it is done
+                done = itertools.imap(run_unit, units)
+                done = self.progress(done, len(units))
+            else:
+                pool = mp.Pool(self.processes, initializer = init_worker)
+                try:
+                    done = pool.imap_unordered(run_unit, units, chunksize = 1)
+                    done = self.progress(done, len(units))
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            _setup = None
+
+        report = {}
+        for worker, cost, busy, _, _, _ in done:
+            stats = report.setdefault(worker, {'units' : 0, 'cost' : 0.,
+                                               'busy' : 0.})
+            stats['units'] += 1
+            stats['cost'] += cost
+            stats['busy'] += busy
+
+        return report
+
+    def progress(self, done, howmany):
+        """ Commit finished units, inform user every 10% of them """
+        results = []
+        step = max(1, howmany / 10)
+        for it, result in enumerate(done):
+            results.append(result)
+            if self.manifest is not None:
+                _, _, _, repeat, keys, name = result
+                self.manifest.commit(self.session, repeat, keys, name)
+
+            if (it + 1) % step == 0 or it + 1 == howmany:
+                info = 'Unit {} of {} done at process {} in time {}'
+                print info.format(it + 1, howmany, result[0], dt.now())
+
+        return results
@@ -1,3 +1,5 @@
+import os
+import json
 import pickle
 import gzip
 from glob import glob
@@ -6,6 +8,30 @@ import numpy as np
 import matplotlib.pyplot as plt
 import xrt.backends.raycing.sources as rs
 
+# Registry of per-ray columns of rs.Beam used for copying, joining,
+# tracing, saving and loading beams: (name, is it kept in beam files)
+_registry = [('state', True), ('x', True), ('y', True), ('z', True),
+             ('a', True), ('b', True), ('c', True), ('path', True),
+             ('E', True), ('Jss', True), ('Jpp', True), ('Jsp', True),
+             ('nRefl', True), ('weight', True), ('channel', False),
+             ('elevationD', False), ('elevationX', False),
+             ('elevationY', False), ('elevationZ', False),
+             ('s', False), ('phi', False), ('r', False), ('theta', False),
+             ('order', False), ('Es', False), ('Ep', False)]
+
+# Columns kept in beam files
+_columns = [name for name, stored in _registry if stored]
+
+# Binary beam is a directory with one raw file per column
+# and a small json header with their dtypes
+BINARY_SUFFIX = '.rays'
+_header_name = 'header.json'
+_header_version = 1
+
+def beam_columns(beam):
+    """ Names of all registered columns present in the beam """
+    return [column for column, _ in _registry if hasattr(beam, column)]
+
 def empty_beam():
     """ Quick way to get a empty rs.Beam insantation """
     return rs.Beam()
@@ -47,37 +73,72 @@ def move_beam_to(beam, where_to):
     beam.z[:] += beam.c * path
     beam.y[:] = where_to
 
+def rotate_beam(beam, angle):
+    """ Copy of the beam rotated around the y (lens) axis,
+    same convention as the capillary roll:
+    x' = cos(angle) x - sin(angle) z, z' = sin(angle) x + cos(angle) z
+    (Jss/Jpp are not rotated, fine for unpolarized beams) """
+    out = copy_by_index(beam, np.ones_like(beam.state, dtype=bool))
+    cos_angle, sin_angle = np.cos(angle), np.sin(angle)
+    out.x = cos_angle * beam.x - sin_angle * beam.z
+    out.z = sin_angle * beam.x + cos_angle * beam.z
+    out.a = cos_angle * beam.a - sin_angle * beam.c
+    out.c = sin_angle * beam.a + cos_angle * beam.c
+
+    return out
+
 def frame_to_beam(frame):
     """ pd.DataFrame to xrt.Beam converter """
     beam = rs.Beam()
     # Convert
-    beam.state = frame.state.values
-    beam.x = frame.x.values
-    beam.y = frame.y.values
-    beam.z = frame.z.values
-    beam.a = frame.a.values
-    beam.b = frame.b.values
-    beam.c = frame.c.values
-    beam.path = frame.path.values
-    beam.E = frame.E.values
-    beam.Jss = frame.Jss.values
-    beam.Jpp = frame.Jpp.values
-    beam.Jsp = frame.Jsp.values
-
-    if 'nRefl' in frame:
-        beam.nRefl = frame.nRefl.values
+    for column in _columns:
+        if column in frame:
+            setattr(beam, column, frame[column].values)
+
+    return beam
+
+def join_beams(beams):
+    """ Single beam with columns of all *beams* concatenated """
+    if len(beams) == 1:
+        return beams[0]
+
+    beam = rs.Beam()
+    for column, _ in _registry:
+        if all(hasattr(part, column) for part in beams):
+            parts = [getattr(part, column) for part in beams]
+            setattr(beam, column, np.concatenate(parts))
 
     return beam
 
-def load_beam(folder):
-    """ Create beam from multiple csv files inside one folder """
+def load_beam(folder, mapped = False):
+    """ Create beam from multiple csv files and binary
+    beams (see BeamWriter) inside one folder, with *mapped*
+    binary beams are memory mapped (see MappedBeam) """
+    if mapped:
+        beam = MappedBeam(folder)
+
+        # Same cleanup as below, but with a mask
+        nRefl_max = beam.reduce('nRefl', np.max)
+        if nRefl_max is not None:
+            beam.select(lambda part: part.nRefl < nRefl_max)
+        return beam
+
+    beams = []
+
     files = glob(folder + '/*csv')
     frames = []
     for file in files:
         frames.append(pd.DataFrame.from_csv(file))
 
     # Create beam from multiple pd.DataFrames
-    beam = frame_to_beam(pd.concat(frames))
+    if frames:
+        beams.append(frame_to_beam(pd.concat(frames)))
+
+    # And from binary files
+    for path in binary_paths(folder):
+        beams.append(read_binary_beam(path))
+
+    beam = join_beams(beams)
 
     # FIXME remove photons with too many reflections
     # since they are obviously ill, investigate why is so pls
@@ -90,26 +151,401 @@ def load_beam(folder):
 def make_dataframe(beam):
     """ Conver beam to a pd.DataFrame object """
     # Create a dictionary with {column : series}
-    data = {'state'     : pd.Series(beam.state),
-            'x'         : pd.Series(beam.x),
-            'y'         : pd.Series(beam.y),
-            'z'         : pd.Series(beam.z),
-            'a'         : pd.Series(beam.a),
-            'b'         : pd.Series(beam.b),
-            'c'         : pd.Series(beam.c),
-            'path'      : pd.Series(beam.path),
-            'E'         : pd.Series(beam.E),
-            'Jss'       : pd.Series(beam.Jss),
-            'Jpp'       : pd.Series(beam.Jpp),
-            'Jsp'       : pd.Series(beam.Jsp)
-            }
-    # Update with columns that not necessary exiest in a beam
-    if hasattr(beam, 'nRefl'):
-        data.update({'nRefl' : beam.nRefl})
+    data = dict((column, pd.Series(getattr(beam, column)))
+                for column in _columns if hasattr(beam, column))
 
     frame = pd.DataFrame(data)
     return frame
 
+class BeamAccumulator(object):
+    """ Collects rays of many beams in preallocated columns.
+    Beam.concatenate copies everything gathered so far on every
+    call, here buffers grow geometrically or are reserved
+    upfront when the final number of rays is known """
+    def __init__(self, capacity = 0, dtypes = None):
+        """ Columns and their dtypes are taken from the
+        first appended beam unless given as *dtypes* """
+        self.capacity = capacity
+        self.size = 0
+        self.dtypes = dtypes
+        self.buffers = None
+
+    def __len__(self):
+        """ Number of collected rays """
+        return self.size
+
+    def reserve(self, howmany):
+        """ Make room for *howmany* more rays """
+        needed = self.size + howmany
+        if self.buffers is None:
+            self.capacity = max(self.capacity, needed)
+        elif needed > self.capacity:
+            self.grow(needed)
+
+    def allocate(self, beam, capacity):
+        """ Empty buffers for columns of the first beam """
+        if self.dtypes is None:
+            self.dtypes = dict((column, getattr(beam, column).dtype)
+                               for column in beam_columns(beam))
+        self.buffers = dict((column, np.empty(capacity, dtype))
+                            for column, dtype in self.dtypes.items())
+        self.capacity = capacity
+
+    def grow(self, needed):
+        """ At least double the capacity, so appends are amortized O(1) """
+        capacity = max(needed, 2 * self.capacity)
+        for column, values in self.buffers.items():
+            bigger = np.empty(capacity, values.dtype)
+            bigger[:self.size] = values[:self.size]
+            self.buffers[column] = bigger
+        self.capacity = capacity
+
+    def append(self, beam):
+        """ Copy all rays of the beam into the buffers """
+        howmany = beam.state.size
+        if self.buffers is None:
+            self.allocate(beam, max(self.capacity, howmany))
+        elif self.size + howmany > self.capacity:
+            self.grow(self.size + howmany)
+
+        start, stop = self.size, self.size + howmany
+        for column, values in self.buffers.items():
+            values[start:stop] = getattr(beam, column)
+        self.size = stop
+
+    def column(self, column):
+        """ Collected values of one column (a view) """
+        return self.buffers[column][:self.size]
+
+    def clear(self):
+        """ Start over reusing the buffers, beams
+        finalized before get overwritten """
+        self.size = 0
+
+    def finalize(self):
+        """ rs.Beam with the collected rays, columns are
+        views of the buffers so nothing is copied """
+        beam = rs.Beam()
+        if self.buffers is None:
+            return beam
+
+        for column in self.buffers:
+            setattr(beam, column, self.column(column))
+        return beam
+
+class CsvWriter(object):
+    """ Appends rays to a text csv file (slow, kept for reference) """
+    def __init__(self, filepath):
+        """ One file per process """
+        self.filepath = filepath
+
+    def write(self, beam):
+        """ Append all rays """
+        frame = make_dataframe(beam)
+
+        # Add header only when creating the file
+        header_needed = not os.path.isfile(self.filepath)
+        frame.to_csv(self.filepath, mode='a', header=header_needed)
+
+    def close(self):
+        """ Nothing is buffered """
+        pass
+
+class BeamWriter(object):
+    """ Appends rays to a binary columnar beam: directory with
+    one raw file per column, written in big buffered chunks """
+    def __init__(self, path, buffer_size = 10**6):
+        """ Rays are kept in memory until *buffer_size* is reached """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = None
+        self.dtypes = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Appending to an existing beam
+        header = os.path.join(path, _header_name)
+        if os.path.isfile(header):
+            self.dtypes = binary_columns(path)
+
+    def write(self, beam):
+        """ Append all rays """
+        if self.dtypes is None:
+            self.write_header(beam)
+
+        if self.buffer is None:
+            self.buffer = BeamAccumulator(self.buffer_size, self.dtypes)
+
+        self.buffer.append(beam)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_header(self, beam):
+        """ Column names and dtypes, taken from the first beam """
+        self.dtypes = {}
+        for column in _columns:
+            if hasattr(beam, column):
+                self.dtypes[column] = getattr(beam, column).dtype
+
+        columns = dict((column, dtype.str)
+                       for column, dtype in self.dtypes.items())
+        header = {'version' : _header_version, 'columns' : columns}
+        with open(os.path.join(self.path, _header_name), 'w') as f:
+            json.dump(header, f)
+
+    def flush(self):
+        """ One large write per column """
+        if self.buffer is None or len(self.buffer) == 0:
+            return
+
+        for column in self.dtypes:
+            filepath = _column_path(self.path, column)
+            with open(filepath, 'ab') as f:
+                self.buffer.column(column).tofile(f)
+
+        self.buffer.clear()
+
+    def close(self):
+        """ Write whatever is left """
+        self.flush()
+
+def binary_paths(folder):
+    """ Binary beams of the folder, skips the ones
+    that never got any rays (no header) """
+    paths = sorted(glob(folder + '/*' + BINARY_SUFFIX))
+    return [path for path in paths
+            if os.path.isfile(os.path.join(path, _header_name))]
+
+def binary_columns(path):
+    """ Column names and dtypes of a binary beam """
+    with open(os.path.join(path, _header_name)) as f:
+        header = json.load(f)
+    columns = header['columns']
+    return dict((str(column), np.dtype(str(dtype)))
+                for column, dtype in columns.items())
+
+def _column_path(path, column):
+    """ Raw file of one beam column """
+    return os.path.join(path, column + '.col')
+
+def binary_size(path):
+    """ Number of complete rays in a binary beam """
+    columns = binary_columns(path)
+
+    # A killed writer may leave columns of different lengths
+    sizes = [os.path.getsize(_column_path(path, column)) // dtype.itemsize
+             for column, dtype in columns.items()]
+    return min(sizes)
+
+def map_binary_beam(path, mode = 'r'):
+    """ Beam with columns being views into the files
+    written by BeamWriter, no data is read here """
+    beam = rs.Beam()
+    size = binary_size(path)
+    for column, dtype in binary_columns(path).items():
+        # np.memmap can not map empty files
+        if size == 0:
+            values = np.empty(0, dtype)
+        else:
+            values = np.memmap(_column_path(path, column), dtype = dtype,
+                               mode = mode, shape = (size,))
+        setattr(beam, column, values)
+
+    return beam
+
+class MappedBeam(object):
+    """ All binary beams of a folder mapped into memory. Rays are
+    filtered with boolean masks, columns are read only when used.
+    Copy on read: the first beam.x reads the selected rays into
+    memory once and keeps them as a plain attribute, so in place
+    helpers (move_beam_to...) work and files are never changed.
+    reduce and selected work on the mapped files without copies """
+    def __init__(self, folder):
+        """ One mapped rs.Beam per process file """
+        paths = binary_paths(folder)
+        self.parts = [map_binary_beam(path) for path in paths]
+        self.masks = [None] * len(self.parts)
+
+    def __len__(self):
+        """ Number of selected rays """
+        howmany = 0
+        for part, mask in zip(self.parts, self.masks):
+            howmany += part.state.size if mask is None else mask.sum()
+        return howmany
+
+    def __getattr__(self, column):
+        """ beam.x etc. like in rs.Beam """
+        if column in _columns:
+            return self.column(column)
+        raise AttributeError(column)
+
+    def select(self, condition):
+        """ Narrow the selection to rays for which *condition(part)*
+        is True, it gets each mapped rs.Beam and returns a bool array.
+        Columns read so far (and changes made to them) are dropped """
+        for it, part in enumerate(self.parts):
+            mask = np.asarray(condition(part), dtype = bool)
+            if self.masks[it] is not None:
+                mask &= self.masks[it]
+            self.masks[it] = mask
+
+        for column in _columns:
+            self.__dict__.pop(column, None)
+        return self
+
+    def selected(self):
+        """ Pairs of mapped beams with their masks (None for all rays) """
+        return zip(self.parts, self.masks)
+
+    def read(self, column):
+        """ In-memory copy of the selected rays of one column """
+        values = [getattr(part, column) if mask is None
+                  else getattr(part, column)[mask]
+                  for part, mask in self.selected()]
+        if not values:
+            return np.empty(0)
+        return np.concatenate(values)
+
+    def column(self, column):
+        """ Values of the selected rays, read once and
+        kept until the selection changes """
+        if column not in self.__dict__:
+            self.__dict__[column] = self.read(column)
+        return self.__dict__[column]
+
+    def reduce(self, column, function):
+        """ Apply a reduction (np.max, np.sum...) part by part,
+        None if there are no rays """
+        results = [function(getattr(part, column) if mask is None
+                            else getattr(part, column)[mask])
+                   for part, mask in self.selected()
+                   if part.state.size > 0 and
+                   (mask is None or mask.any())]
+        if not results:
+            return None
+        return function(results)
+
+    def to_beam(self):
+        """ In-memory rs.Beam with the selected rays,
+        columns already read (and changed) are shared """
+        beam = rs.Beam()
+        for column in _columns:
+            if self.parts and all(hasattr(part, column)
+                                  for part in self.parts):
+                setattr(beam, column, self.column(column))
+        return beam
+
+def read_binary_beam(path):
+    """ Reads a beam written by BeamWriter """
+    beam = rs.Beam()
+    columns = binary_columns(path)
+
+    size = binary_size(path)
+    for column, dtype in columns.items():
+        values = np.fromfile(_column_path(path, column), dtype, count = size)
+        setattr(beam, column, values)
+
+    return beam
+
+def slice_beam(beam, start, stop):
+    """ Rays start:stop of the beam, same semantics as
+    beam.x[start:stop]. A plain rs.Beam (xrt copies only those)
+    with scalar attributes of the parent, columns are views of
+    the parent arrays, so nothing is copied (and changes are shared) """
+    view = rs.Beam(nrays=0)
+    for name, value in vars(beam).items():
+        if not isinstance(value, np.ndarray):
+            setattr(view, name, value)
+    for column in beam_columns(beam):
+        setattr(view, column, getattr(beam, column)[start:stop])
+    return view
+
+def cache_size(level = 2, default = 2**20):
+    """ Size [B] of the CPU data cache of given *level*
+    (from linux sysfs), *default* when it is unknown """
+    for path in sorted(glob('/sys/devices/system/cpu/cpu0/cache/index*')):
+        try:
+            with open(path + '/level') as f:
+                cache_level = int(f.read())
+            with open(path + '/type') as f:
+                cache_type = f.read().strip()
+            with open(path + '/size') as f:
+                size = f.read().strip()
+        except (IOError, ValueError):
+            continue
+
+        if cache_level != level or cache_type == 'Instruction':
+            continue
+
+        units = {'K' : 2**10, 'M' : 2**20, 'G' : 2**30}
+        if size[-1] in units:
+            return int(size[:-1]) * units[size[-1]]
+        return int(size)
+
+    return default
+
+def cache_chunk_size(beam, working_copies = 4, minimum = 1000, level = 2):
+    """ Number of rays such that a chunk of the beam together
+    with tracing temporaries (*working_copies* of every column)
+    stays in cache, but not less than *minimum* """
+    ray_bytes = sum(getattr(beam, column).itemsize
+                    for column in beam_columns(beam))
+    return max(minimum, cache_size(level) // (working_copies * ray_bytes))
+
+def _iter_pieces(folder, chunk_size):
+    """ In-memory pieces of at most *chunk_size* rays from
+    every csv and binary beam of the folder """
+    for file in sorted(glob(folder + '/*csv')):
+        for frame in pd.read_csv(file, index_col=0, chunksize=chunk_size):
+            yield frame_to_beam(frame)
+
+    for path in binary_paths(folder):
+        mapped = map_binary_beam(path)
+        size = mapped.state.size
+        for start in range(0, size, chunk_size):
+            piece = slice_beam(mapped, start, start + chunk_size)
+            # Copy out of the (read only) mapping
+            for column in _columns:
+                if hasattr(piece, column):
+                    setattr(piece, column, np.array(getattr(piece, column)))
+            yield piece
+
+def iter_beam(folder, chunk_size = 10**6, filters = [], transforms = []):
+    """ Generator over all rays of a folder in rs.Beam chunks of
+    *chunk_size* rays (only the last one can be smaller), so memory
+    use does not depend on the number of rays in the folder.
+    *filters* are functions beam -> bool array of rays to keep
+    (e.g. utils.cutter.outside_circle), *transforms* are applied
+    to every chunk afterwards and either return a new beam or
+    modify it in place (e.g. lambda b: move_beam_to(b, 200)) """
+    pending = []
+    howmany = 0
+    for piece in _iter_pieces(folder, chunk_size):
+        for condition in filters:
+            piece = copy_by_index(piece, condition(piece))
+        pending.append(piece)
+        howmany += piece.state.size
+
+        # Full chunks are cut from the joined pieces
+        while howmany >= chunk_size:
+            joined = join_beams(pending)
+            chunk = slice_beam(joined, 0, chunk_size)
+            pending = [slice_beam(joined, chunk_size, howmany)]
+            howmany -= chunk_size
+            yield _transformed(chunk, transforms)
+
+    if howmany > 0:
+        yield _transformed(join_beams(pending), transforms)
+
+def _transformed(beam, transforms):
+    """ Apply transforms in order """
+    for transform in transforms:
+        result = transform(beam)
+        if result is not None:
+            beam = result
+    return beam
+
 def show_beam_part(beam, idarr):
     """ Shows photons within an array of ids """
     xx = beam.x[idarr]
@@ -133,42 +569,48 @@ def plot_beam(beam, pos):
 
 def copy_by_index(beam, indarr):
     """ Copies a part of beam """
+    # Boolean masks and lists are turned into indices once,
+    # not separately for every column
+    if not isinstance(indarr, slice):
+        indarr = np.asarray(indarr)
+        if indarr.dtype == bool:
+            indarr = np.flatnonzero(indarr)
+
     outbeam = rs.Beam()
-    outbeam.state = beam.state[indarr]
-    outbeam.x = beam.x[indarr]
-    outbeam.y = beam.y[indarr]
-    outbeam.z = beam.z[indarr]
-    outbeam.a = beam.a[indarr]
-    outbeam.b = beam.b[indarr]
-    outbeam.c = beam.c[indarr]
-    outbeam.path = beam.path[indarr]
-    outbeam.E = beam.E[indarr]
-    outbeam.Jss = beam.Jss[indarr]
-    outbeam.Jpp = beam.Jpp[indarr]
-    outbeam.Jsp = beam.Jsp[indarr]
-    if hasattr(beam, 'nRefl'):
-        outbeam.nRefl = beam.nRefl[indarr]
-    if hasattr(beam, 'elevationD'):
-        outbeam.elevationD = beam.elevationD[indarr]
-        outbeam.elevationX = beam.elevationX[indarr]
-        outbeam.elevationY = beam.elevationY[indarr]
-        outbeam.elevationZ = beam.elevationZ[indarr]
-    if hasattr(beam, 's'):
-        outbeam.s = beam.s[indarr]
-    if hasattr(beam, 'phi'):
-        outbeam.phi = beam.phi[indarr]
-    if hasattr(beam, 'r'):
-        outbeam.r = beam.r[indarr]
-    if hasattr(beam, 'theta'):
-        outbeam.theta = beam.theta[indarr]
-    if hasattr(beam, 'order'):
-        outbeam.order = beam.order[indarr]
-    if hasattr(beam, 'Es'):
-        outbeam.Es = beam.Es[indarr]
-        outbeam.Ep = beam.Ep[indarr]
+    for column in beam_columns(beam):
+        setattr(outbeam, column, getattr(beam, column)[indarr])
 
     return outbeam
 
+def compact_beam(beam, mask, block_size = 2**16):
+    """ In place version of copy_by_index: rays selected by the
+    bool *mask* are moved to the front of the existing arrays
+    and columns become views of that front part. Only
+    temporaries of *block_size* rays are allocated """
+    mask = np.asarray(mask)
+    if mask.dtype != bool:
+        indices = mask
+        mask = np.zeros(beam.state.size, dtype=bool)
+        mask[indices] = True
+
+    names = beam_columns(beam)
+    columns = [getattr(beam, column) for column in names]
+
+    # Selected ray number j sits at position >= j, so gathering
+    # block by block never overwrites rays not yet moved
+    kept = 0
+    for start in range(0, mask.size, block_size):
+        ids = np.flatnonzero(mask[start:start + block_size])
+        ids += start
+        for values in columns:
+            values[kept:kept + ids.size] = values[ids]
+        kept += ids.size
+
+    for column, values in zip(names, columns):
+        setattr(beam, column, values[:kept])
+
+    return beam
+
 def save_beam(beam, filename = 'global_total.beam'):
     """ OBSOLETE Simply pickle the beam """
     file = open(filename, 'wb')
@@ -0,0 +1,26 @@
+""" Seeded random streams: every (repeat, capillary) of a run gets
+its own numpy RandomState derived from the root seed only, so runs
+are reproducible whatever the number of processes and order of work
+units, and a single unit can be re-run in isolation """
+import hashlib
+import numpy as np
+
+def stream_seed(seed, *keys):
+    """ 256 bits of entropy for the stream under *keys*,
+    as uint32 words accepted by np.random.RandomState """
+    key = ','.join(str(it) for it in (seed,) + keys)
+    digest = hashlib.sha256(key).digest()
+    return np.frombuffer(digest, dtype='<u4')
+
+def make_stream(seed, *keys):
+    """ RandomState of the stream keyed by e.g. (repeat, capillary id),
+    streams with different keys are independent. Seed None gives
+    a fresh, not reproducible, stream """
+    if seed is None:
+        return np.random.RandomState()
+    return np.random.RandomState(stream_seed(seed, *keys))
+
+def use_stream(stream):
+    """ Code drawing from the global np.random (xrt energy and
+    polarization distributions) continues the *stream* """
+    np.random.seed(stream.randint(0, 2**32, size = 4).astype(np.uint32))